@@ -104,7 +104,46 @@ def runcmd_unchecked(argv, *argvs, **kwargs):
         else:
             raise
 
+def _close_open_fds(): # pragma: no cover
+    '''Close the inherited file descriptors of a child process.
+
+    Run in the child between fork and exec. Only the descriptors listed
+    in /proc/self/fd are looked at, instead of every possible one up to
+    RLIMIT_NOFILE as close_fds=True does on Python 2. Descriptors with
+    FD_CLOEXEC set are left for exec to close, that includes the pipe
+    subprocess uses to report exec failures.
+
+    '''
+
+    for name in os.listdir('/proc/self/fd'):
+        fd = int(name)
+        if fd <= 2:
+            continue
+        try:
+            if not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                os.close(fd)
+        except (IOError, OSError):
+            # the descriptor listdir used is already closed
+            pass
+
+def _spawn_kwargs(kwargs):
+    '''Return the Popen keyword arguments used to close inherited fds.
+
+    The caller's own close_fds or preexec_fn are respected.
+
+    '''
+
+    if 'close_fds' in kwargs or 'preexec_fn' in kwargs:
+        return dict(kwargs)
+    spawn_kwargs = dict(kwargs)
+    if os.path.isdir('/proc/self/fd'):
+        spawn_kwargs['preexec_fn'] = _close_open_fds
+    else: # pragma: no cover
+        spawn_kwargs['close_fds'] = True
+    return spawn_kwargs
+
 def _build_pipeline(argvs, pipe_stdin, pipe_stdout, pipe_stderr, kwargs):
+    spawn_kwargs = _spawn_kwargs(kwargs)
     procs = []
     for i, argv in enumerate(argvs):
         if i == 0 and i == len(argvs) - 1:
@@ -124,7 +163,7 @@ def _build_pipeline(argvs, pipe_stdin, pipe_stdout, pipe_stderr, kwargs):
             stdout = subprocess.PIPE
             stderr = pipe_stderr
         p = subprocess.Popen(argv, stdin=stdin, stdout=stdout,
-                             stderr=stderr, close_fds=True, **kwargs)
+                             stderr=stderr, **spawn_kwargs)
         procs.append(p)
 
     return procs
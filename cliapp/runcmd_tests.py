@@ -124,6 +124,25 @@ class RuncmdTests(unittest.TestCase):
         self.assertEqual(exit, 0)
         self.assertEqual(data, '')
 
+    def open_high_fd(self):
+        fd = os.open('/dev/null', os.O_RDONLY)
+        os.dup2(fd, 100)
+        os.close(fd)
+        self.addCleanup(os.close, 100)
+
+    def test_runcmd_closes_inherited_fds(self):
+        self.open_high_fd()
+        out = cliapp.runcmd(['ls', '/proc/self/fd'])
+        self.assertFalse('100' in out.split())
+
+    def test_runcmd_keeps_inherited_fds_on_request(self):
+        self.open_high_fd()
+        out = cliapp.runcmd(['ls', '/proc/self/fd'], close_fds=False)
+        self.assertTrue('100' in out.split())
+
+    def test_runcmd_raises_oserror_for_missing_command(self):
+        self.assertRaises(OSError, cliapp.runcmd, ['/does/not/exist'])
+
 
 class ShellQuoteTests(unittest.TestCase):
 
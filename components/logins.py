@@ -1,11 +1,29 @@
-from fog_lib import FogRequester, obtain_logins
+from fog_lib import FogRequester, Outbox, login_events
+from fog_logins import SessionIndex, login_sources, state_write
 
 import logging
 import base64
+import itertools
+import time
+from multiprocessing.pool import ThreadPool
+
+LAST_LOG = "/var/lib/fog_client_linux_last_log"
 
 
 class LoginsRequester(FogRequester):
-    """Set logins data on fog server"""
+    """Set logins data on fog server
+
+    Batches go to their own service, a server without it answers with an
+    error page instead of FOG_OK. usertracking.report can't be probed: it
+    takes a request without action as a logout and answers FOG_OK.
+    """
+    BATCH_SERVICE = "usertracking.batch"
+
+    def __init__(self, mac, fog_host, outbox=None):
+        super(LoginsRequester, self).__init__(mac, fog_host, outbox)
+        self.batch_supported = None
+        self.batch_size = BatchSize()
+
     def _handler(self, text):
         """Process data from fog server and returns hostname"""
         return text
@@ -16,7 +34,11 @@ class LoginsRequester(FogRequester):
     def _data(self, date):
         return base64.b64encode(str(date))
 
-    def _set_login_data(self, login, last_logged_date):
+    def _action(self, login):
+        action = "login" if login["action"] == "open" else "logout"
+        return base64.b64encode(action)
+
+    def _set_login_data(self, login):
             params = dict(service="usertracking.report",
                           user=self._user(login["user"]),
                           date=self._data(login["date"]))
@@ -24,31 +46,143 @@ class LoginsRequester(FogRequester):
             if login["action"] == "open":
                 params["action"] = base64.b64encode("login")
 
-            text = self.get_data(**params)
+            text = self.report(**params)
 
-            if text == self.FOG_OK and login["date"] > last_logged_date:
-                save_last_logged(login)
             print text
+            return text == self.FOG_OK
+
+    def _set_batch_login_data(self, logins):
+        """Reports :logins in a single request"""
+        entries = (":".join([self._user(login["user"]),
+                             self._data(login["date"]),
+                             self._action(login)])
+                   for login in logins)
+        text = self.get_data(service=self.BATCH_SERVICE,
+                             logins=",".join(entries))
+        return text.strip() == self.FOG_OK
+
+    def _report(self, logins):
+        """Reports :logins, in one request if the server accepts batches.
+        Returns True if the server acknowledged all of them.
+
+        Batches are never queued in the outbox, their logins are queued one
+        by one instead.
+        """
+        queueing = self.outbox is not None and self.outbox.pending
+        if (len(logins) > 1 and self.batch_supported is not False
+                and not queueing):
+            start = time.time()
+            try:
+                acknowledged = self._set_batch_login_data(logins)
+            except IOError as e:
+                logging.info(e)
+            else:
+                self.batch_size.update(acknowledged, time.time() - start)
+                if acknowledged:
+                    self.batch_supported = True
+                    return True
+                if self.batch_supported is None:
+                    logging.info("Server does not accept batch login "
+                                 "reports")
+                    self.batch_supported = False
+        return all([self._set_login_data(login) for login in logins])
+
+    def _rounds(self, logins, concurrency):
+        """Yields lists of at most :concurrency batches of logins, sized
+        when the previous round is done"""
+        position = 0
+        while position < len(logins):
+            size = self.batch_size.size if self.batch_supported else 1
+            batches = [logins[start:start + size]
+                       for start in xrange(position, len(logins), size)]
+            if self.batch_supported is None:
+                batches = [logins[position:position + self.batch_size.size]]
+            batches = batches[:concurrency]
+            position += sum(len(batch) for batch in batches)
+            yield batches
+
+    def set_logins_data(self, logins, last_logged_date, concurrency=4):
+        """Returns True if the server acknowledged every login.
+
+        Up to :concurrency reports are in flight at once. The last logged
+        date only moves past logins acknowledged together with every login
+        before them.
+        """
+        checkpoint = LastLoggedCheckpoint(self.outbox)
+        acknowledged = True
+        pool = ThreadPool(concurrency)
+        try:
+            for batches in self._rounds(logins, concurrency):
+                results = pool.map(self._report, batches)
+                for batch, result in itertools.izip(batches, results):
+                    acknowledged = result and acknowledged
+                    for login in batch:
+                        if acknowledged and login["date"] > last_logged_date:
+                            checkpoint.record(login)
+        finally:
+            pool.terminate()
+            checkpoint.flush()
+
+        return acknowledged
 
-    def set_logins_data(self, logins, last_logged_date):
-        "Returns hostname saved on fog server"
 
-        for login in logins:
-            self._set_login_data(login, last_logged_date)
+class BatchSize(object):
+    """Number of logins sent per batch report. It grows while the server
+    answers within :target seconds and halves on slow answers or
+    failures."""
+    def __init__(self, size=8, maximum=64, target=1.0):
+        super(BatchSize, self).__init__()
+        self.size = size
+        self.maximum = maximum
+        self.target = target
 
-        return True
+    def update(self, acknowledged, elapsed):
+        if acknowledged and elapsed < self.target:
+            self.size = min(self.maximum, self.size + 4)
+        else:
+            self.size = max(1, self.size // 2)
+
+
+class LastLoggedCheckpoint(object):
+    """Keeps the last acknowledged login in memory and saves it every
+    :every logins or :interval seconds, and when flushed.
+
+    Logins queued in :outbox are synced to disk before the save.
+    """
+    def __init__(self, outbox=None, every=100, interval=5):
+        super(LastLoggedCheckpoint, self).__init__()
+        self.outbox = outbox
+        self.every = every
+        self.interval = interval
+        self.login = None
+        self.pending = 0
+        self.saved_at = time.time()
+
+    def record(self, login):
+        self.login = login
+        self.pending += 1
+        if (self.pending >= self.every
+                or time.time() - self.saved_at >= self.interval):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            if self.outbox is not None:
+                self.outbox.sync()
+            save_last_logged(self.login)
+            self.pending = 0
+            self.saved_at = time.time()
 
 
 def save_last_logged(login):
     date = login["date"]
-    with open("/var/lib/fog_client_linux_last_log", "w") as file:
-        file.write(str(date))
+    state_write(LAST_LOG, str(date))
 
 
 def load_last_logged():
     import datetime
     try:
-        with open("/var/lib/fog_client_linux_last_log", "r") as file:
+        with open(LAST_LOG, "r") as file:
             date_string = file.read()
             return datetime.datetime.strptime(date_string, "%Y-%m-%d %H:%M:%S")
     except:
@@ -60,19 +194,69 @@ def logins_to_insert(logins, last_logged_date):
             if login["date"] > last_logged_date]
 
 
-def client_logins(fog_host, mac):
+def compact_logins(logins, window=0):
+    """Returns :logins sorted by date, without exact duplicates and with
+    flaps merged: a session closed and opened again by the same user and
+    program within :window seconds is reported as one session, dropping
+    the close and the re-open.
+
+    Logins with the same date keep their order in the log.
+    """
+    seen = set()
+    unique = []
+    for login in logins:
+        key = login["date"], login["user"], login["program"], login["action"]
+        if key not in seen:
+            seen.add(key)
+            unique.append(login)
+    ordered = sorted(unique, key=lambda login: login["date"])
+
+    closed = {}
+    merged = set()
+    for index, login in enumerate(ordered):
+        session = login["user"], login["program"]
+        if login["action"] == "close":
+            closed[session] = index
+        elif session in closed:
+            close_index = closed.pop(session)
+            gap = login["date"] - ordered[close_index]["date"]
+            if gap.total_seconds() <= window:
+                merged.update([close_index, index])
+
+    compacted = [login for index, login in enumerate(ordered)
+                 if index not in merged]
+    if logins:
+        removed = len(logins) - len(compacted)
+        logging.info("Compaction removed %d of %d logins (%.1f%%)", removed,
+                     len(logins), 100.0 * removed / len(logins))
+    return compacted
+
+
+def client_logins(fog_host, mac, concurrency=4, compact_window=0,
+                  processes=1, sources=("auth.log",)):
     """Main function for this module"""
 
     last_logged_date = load_last_logged()
 
-    logins_logouts = obtain_logins()
-    logins = logins_to_insert(logins_logouts, last_logged_date)
+    outbox = Outbox()
+    outbox.replay(concurrency)
+
+    reader = login_sources(sources, processes)
+    logins_logouts = login_events(reader.session_logs(since=last_logged_date))
+    logins = compact_logins(logins_to_insert(logins_logouts, last_logged_date),
+                            compact_window)
 
     if len(logins) > 0:
         fog_requester = LoginsRequester(fog_host=fog_host,
-                                        mac=base64.b64encode(mac))
-        fog_requester.set_logins_data(logins, last_logged_date)
+                                        mac=base64.b64encode(mac),
+                                        outbox=outbox)
+        if fog_requester.set_logins_data(logins, last_logged_date,
+                                         concurrency):
+            reader.commit()
     else:
         logging.info("No logins to notify server")
+        reader.commit()
+
+    SessionIndex(sources=sources).refresh()
 
     return True
@@ -0,0 +1,199 @@
+import base64
+import BaseHTTPServer
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+import components.logins
+
+logins_module = sys.modules["components.logins"]
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers usertracking.report like a fog server, with or without
+    batch support"""
+
+    def log_message(self, *args):
+        pass
+
+    def _login(self, user, date):
+        user = base64.b64decode(user).split("\\", 1)[1]
+        self.server.received.append((user, base64.b64decode(date)))
+        return user not in self.server.failing
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        time.sleep(self.server.delay)
+        if url.path == "/fog/service/usertracking.batch.php":
+            self.server.batches += 1
+            if not self.server.batch:
+                # a legacy server has no such service
+                self.send_error(404)
+                return
+            ok = all([self._login(*entry.split(":")[:2])
+                      for entry in params["logins"].split(",")])
+        elif "user" not in params:
+            # like a legacy usertracking.report, a request without action
+            # is a logout, recorded whatever it holds
+            self.server.bogus += 1
+            ok = True
+        else:
+            self.server.singles += 1
+            ok = self._login(params["user"], params["date"])
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write("#!ok" if ok else "#!er")
+
+
+class StandInServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, batch=True, delay=0, failing=()):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           StandInHandler)
+        self.batch = batch
+        self.delay = delay
+        self.failing = set(failing)
+        self.received = []
+        self.batches = 0
+        self.singles = 0
+        self.bogus = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def host(self):
+        return "127.0.0.1:%d" % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_logins(users):
+    start = datetime.datetime(2027, 1, 1)
+    return [{"user": user, "program": "lightdm", "action": "open",
+             "date": start + datetime.timedelta(minutes=index)}
+            for index, user in enumerate(users)]
+
+
+class LoginsRequesterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.saved_last_log = logins_module.LAST_LOG
+        logins_module.LAST_LOG = os.path.join(self.dirname, "last_log")
+        self.server = None
+
+    def tearDown(self):
+        logins_module.LAST_LOG = self.saved_last_log
+        shutil.rmtree(self.dirname)
+        if self.server is not None:
+            self.server.stop()
+
+    def report(self, logins, concurrency=4, **server_options):
+        self.server = StandInServer(**server_options)
+        self.requester = logins_module.LoginsRequester(
+            mac=base64.b64encode("00:11:22:33:44:55"),
+            fog_host=self.server.host)
+        return self.requester.set_logins_data(logins, datetime.datetime.min,
+                                              concurrency)
+
+    def test_probe_finds_batch_support(self):
+        logins = make_logins(["user%d" % index for index in xrange(40)])
+        self.assertTrue(self.report(logins))
+        self.assertTrue(self.requester.batch_supported)
+        self.assertEqual(self.server.singles, 0)
+        self.assertEqual(sorted(self.server.received),
+                         sorted((login["user"], str(login["date"]))
+                                for login in logins))
+
+    def test_falls_back_to_per_login_reports(self):
+        logins = make_logins(["user%d" % index for index in xrange(20)])
+        self.assertTrue(self.report(logins, batch=False))
+        self.assertEqual(self.requester.batch_supported, False)
+        self.assertEqual(self.server.batches, 1)
+        self.assertEqual(self.server.singles, 20)
+
+    def test_legacy_server_gets_no_batch_and_no_bogus_rows(self):
+        logins = make_logins(["user%d" % index for index in xrange(20)])
+        self.assertTrue(self.report(logins, batch=False))
+        self.assertEqual(self.requester.batch_supported, False)
+        self.assertEqual(self.server.bogus, 0)
+        self.assertEqual(sorted(self.server.received),
+                         sorted((login["user"], str(login["date"]))
+                                for login in logins))
+
+    def test_batch_size_shrinks_on_slow_answers(self):
+        self.server = StandInServer(delay=0.05)
+        requester = logins_module.LoginsRequester(mac="mac",
+                                                  fog_host=self.server.host)
+        requester.batch_size = logins_module.BatchSize(size=16, target=0.01)
+        requester.set_logins_data(make_logins(["a"] * 16 + ["b"] * 8),
+                                  datetime.datetime.min, 1)
+        self.assertEqual(requester.batch_size.size, 4)
+
+    def test_watermark_stops_before_the_first_unacknowledged_login(self):
+        users = ["user%d" % index for index in xrange(12)]
+        users[9] = "bad"
+        logins = make_logins(users)
+        self.assertFalse(self.report(logins, batch=False, failing=["bad"]))
+        # the logins after the failed one were sent concurrently and
+        # acknowledged, but the watermark doesn't pass the failed one
+        self.assertTrue(("user11", str(logins[11]["date"]))
+                        in self.server.received)
+        self.assertEqual(logins_module.load_last_logged(),
+                         logins[8]["date"])
+
+
+class BatchSizeTests(unittest.TestCase):
+
+    def test_grows_on_fast_acknowledged_batches(self):
+        size = logins_module.BatchSize(size=8, maximum=14, target=1.0)
+        size.update(True, 0.1)
+        self.assertEqual(size.size, 12)
+        size.update(True, 0.1)
+        self.assertEqual(size.size, 14)
+
+    def test_halves_on_slow_batches(self):
+        size = logins_module.BatchSize(size=8, target=1.0)
+        size.update(True, 2.0)
+        self.assertEqual(size.size, 4)
+
+    def test_halves_on_failures_down_to_one(self):
+        size = logins_module.BatchSize(size=2)
+        size.update(False, 0.1)
+        size.update(False, 0.1)
+        self.assertEqual(size.size, 1)
+
+
+class CompactLoginsTests(unittest.TestCase):
+
+    def events(self, *events):
+        start = datetime.datetime(2027, 1, 1)
+        return [{"user": "alice", "program": "lightdm", "action": action,
+                 "date": start + datetime.timedelta(seconds=seconds)}
+                for action, seconds in events]
+
+    def test_merges_a_close_and_quick_reopen(self):
+        logins = self.events(("open", 0), ("close", 10), ("open", 10),
+                             ("close", 100))
+        self.assertEqual(logins_module.compact_logins(logins, 10),
+                         [logins[0], logins[3]])
+
+    def test_keeps_short_genuine_sessions(self):
+        logins = self.events(("open", 0), ("close", 5), ("open", 60),
+                             ("close", 65))
+        self.assertEqual(logins_module.compact_logins(logins, 10), logins)
+
+    def test_drops_duplicates_and_orders_by_date(self):
+        logins = self.events(("close", 100), ("open", 0), ("open", 0))
+        self.assertEqual(logins_module.compact_logins(logins),
+                         [logins[1], logins[0]])
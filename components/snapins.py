@@ -1,8 +1,14 @@
-import cuisine as c
-import subprocess
-from fog_lib import FogRequester, shutdown
+import hashlib
+import random
+import re
+import threading
+from fog_lib import FogRequester, Outbox, shutdown
+from fog_multicast import MulticastReceiver, MulticastSender
+from fog_ops import ops
 import logging
 
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
 
 class SnapinRequester(FogRequester):
     """docstring for SnapinRequester"""
@@ -35,15 +41,16 @@ class SnapinRequester(FogRequester):
         return data
 
     def confirm_snapin(self, snapin):
-        data = self.get_data(service="snapins.checkin",
-                             taskid=snapin.task_id,
-                             exitcode=snapin.return_code)
+        data = self.report(service="snapins.checkin",
+                           taskid=snapin.task_id,
+                           exitcode=snapin.return_code)
         return data == self.FOG_OK
 
 
 class Snapin(object):
     """docstring for Snapin"""
-    def __init__(self, snapin_dict, snapin_dir, fog_requester):
+    def __init__(self, snapin_dict, snapin_dir, fog_requester,
+                 multicast=None):
         super(Snapin, self).__init__()
         self.snapin_dir = snapin_dir
         self.filename = snapin_dict["filename"]
@@ -53,6 +60,12 @@ class Snapin(object):
         self.run_with_args = snapin_dict["runwithargs"]
         self.reboot = True if snapin_dict["bounce"] == 1 else False
         self.fog_requester = fog_requester
+        self.multicast = multicast
+        self.hash = snapin_dict.get("hash", "").strip().lower() or None
+        if self.hash and not SHA256_RE.match(self.hash):
+            logging.info("Snapin hash %s is not a sha256, ignored", self.hash)
+            self.hash = None
+        self.server = None
         self.return_code = 0
 
     @property
@@ -63,42 +76,84 @@ class Snapin(object):
             dirname_slash = self.snapin_dir
         return dirname_slash + self.filename
 
+    def _receive_multicast(self, digest):
+        """Waits for a peer streaming this snapin. If nobody does and this
+        client is elected, downloads it from the server and streams it to
+        the rest of the group."""
+        group, port, wait = self.multicast
+        receiver = MulticastReceiver(group, port, digest)
+        try:
+            data = receiver.receive(timeout=wait + random.uniform(0, 1))
+        except ValueError as e:
+            logging.warning("%s, downloading %s from the server", e,
+                            self.filename)
+            return self.fog_requester.download_snapin(self)
+        if data is not None:
+            logging.info("Snapin %s received by multicast", self.filename)
+            return data
+
+        sender = MulticastSender(group, port, digest)
+        sender.claim(receiver.nonce)
+        try:
+            data = self.fog_requester.download_snapin(self)
+        except Exception:
+            sender.close()
+            raise
+        if hashlib.sha256(data).digest() != digest:
+            sender.close()
+            return data
+        self.server = threading.Thread(target=sender.serve, args=(data,))
+        self.server.daemon = True
+        self.server.start()
+        return data
+
     def _download(self):
-        data = self.fog_requester.download_snapin(self)
+        if self.multicast and self.hash:
+            data = self._receive_multicast(self.hash.decode("hex"))
+        else:
+            if self.multicast:
+                logging.info("No hash for snapin %s, multicast not used",
+                             self.filename)
+            data = self.fog_requester.download_snapin(self)
+        if self.hash and hashlib.sha256(data).hexdigest() != self.hash:
+            raise ValueError("Snapin %s does not match its hash"
+                             % self.filename)
         with open(self.complete_filename, "wb") as snapin_file:
             snapin_file.write(data)
 
     def _execute(self):
-        with c.mode_local():
-            c.file_ensure(self.complete_filename, mode="700")
-
-        line = " ".join([self.run_with, self.run_with_args,
-                        self.complete_filename, self.args])
-        r_code = subprocess.call(line, shell=True)
-        self.return_code = r_code
+        self.return_code = ops().execute(self.complete_filename,
+                                         self.run_with, self.run_with_args,
+                                         self.args)
 
     def _confirm(self):
         self.fog_requester.confirm_snapin(self)
 
     def install(self):
-        with c.mode_sudo():
-            self._download()
-            self._execute()
-            self._confirm()
-
-
-def client_snapin(fog_host, mac, snapin_dir, allow_reboot=False):
-    fog_requester = SnapinRequester(fog_host=fog_host, mac=mac)
+        self._download()
+        self._execute()
+        self._confirm()
+        if self.server is not None:
+            # let the peers get the snapin before a reboot
+            self.server.join()
+
+
+def client_snapin(fog_host, mac, snapin_dir, allow_reboot=False,
+                  multicast=None, context=None):
+    outbox = Outbox()
+    outbox.replay()
+    fog_requester = SnapinRequester(fog_host=fog_host, mac=mac, outbox=outbox)
     action, reboot = False, False
     try:
         snapin_dict = fog_requester.get_snapin_data()
-        snapin = Snapin(snapin_dict, snapin_dir, fog_requester)
+        snapin = Snapin(snapin_dict, snapin_dir, fog_requester, multicast)
         snapin.install()
+        outbox.sync()
         logging.info("Installed " + snapin.complete_filename +
                      " with returncode " + str(snapin.return_code))
         action, reboot = True, snapin.reboot
         if allow_reboot and reboot:
-            shutdown(mode="reboot")
+            shutdown(mode="reboot", context=context)
     except IOError as e:
         logging.info(e)
     except ValueError as e:
@@ -0,0 +1,65 @@
+import hashlib
+import shutil
+import tempfile
+import threading
+import unittest
+
+from components.snapins import Snapin
+from fog_multicast import MulticastSender
+
+GROUP = "239.255.42.99"
+
+
+class FakeRequester(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.downloads = 0
+
+    def download_snapin(self, snapin):
+        self.downloads += 1
+        return self.data
+
+
+class SnapinDownloadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.data = "#!/bin/sh\necho trusted\n"
+        self.hash = hashlib.sha256(self.data).hexdigest()
+        self.requester = FakeRequester(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def snapin(self, snapin_hash, multicast=None):
+        return Snapin({"filename": "s.sh", "jobtaskid": "1", "args": "",
+                       "runwith": "", "runwithargs": "", "bounce": "0",
+                       "hash": snapin_hash},
+                      self.dirname, self.requester, multicast)
+
+    def downloaded(self, snapin):
+        with open(snapin.complete_filename, "rb") as snapin_file:
+            return snapin_file.read()
+
+    def test_forged_multicast_stream_falls_back_to_server(self):
+        forged = MulticastSender(GROUP, 9311, self.hash.decode("hex"))
+        server = threading.Thread(target=forged.serve,
+                                  args=("#!/bin/sh\necho evil\n", 0.5))
+        server.start()
+        snapin = self.snapin(self.hash, (GROUP, 9311, 2))
+        try:
+            snapin._download()
+        finally:
+            server.join()
+        self.assertEqual(self.downloaded(snapin), self.data)
+        self.assertEqual(self.requester.downloads, 1)
+
+    def test_server_download_not_matching_the_hash_is_refused(self):
+        snapin = self.snapin(hashlib.sha256("other").hexdigest())
+        self.assertRaises(ValueError, snapin._download)
+
+    def test_multicast_is_not_used_without_a_hash(self):
+        snapin = self.snapin("", (GROUP, 9312, 60))
+        snapin._download()
+        self.assertEqual(self.downloaded(snapin), self.data)
@@ -5,9 +5,14 @@ import cliapp
 import filelock
 
 import components
-from fog_lib import get_macs, Scheduler
+import fog_ops
+from fog_lib import HostContext, Scheduler
+from fog_helper import Helper
+from fog_logins import login_watcher
 
 import logging
+import multiprocessing
+import pwd
 
 
 class FogClientApp(cliapp.Application):
@@ -18,8 +23,9 @@ class FogClientApp(cliapp.Application):
                              'localhost).',
                              default='localhost')
         self.settings.string(['snapin_dir'],
-                             'Directory where snapin files are saved (default:'
-                             '/tmp/).',
+                             'Directory where snapin files are saved, owned '
+                             'by root and not writable by others when the '
+                             'helper is used (default: /tmp/).',
                              default='/tmp/')
         self.settings.boolean(['allow_reboot'],
                               'Permit reboots or shutdowns if needed (default:'
@@ -29,6 +35,71 @@ class FogClientApp(cliapp.Application):
                               'Sets interval between service execution '
                               '(default: 5).',
                               default=5)
+        self.settings.string(['multicast_group'],
+                             'Multicast group used to share snapin downloads '
+                             'with other clients, empty to disable (default: '
+                             'empty).',
+                             default='')
+        self.settings.integer(['multicast_port'],
+                              'UDP port of the snapin multicast group '
+                              '(default: 9099).',
+                              default=9099)
+        self.settings.integer(['multicast_wait'],
+                              'Seconds to wait for a peer streaming a snapin '
+                              'before downloading it from the server '
+                              '(default: 10).',
+                              default=10)
+        self.settings.integer(['login_concurrency'],
+                              'Maximum login reports sent to the server at '
+                              'once (default: 4).',
+                              default=4)
+        self.settings.integer(['login_compact_window'],
+                              'A session closed and opened again within '
+                              'these seconds is reported as one session '
+                              '(default: 0).',
+                              default=0)
+        self.settings.integer(['catch_up_processes'],
+                              'Processes used to read large login backlogs, '
+                              '0 for one per CPU (default: 0).',
+                              default=0)
+        self.settings.string_list(['login_sources'],
+                                  'Where logins are read from, any of '
+                                  'auth.log, wtmp and journal. Events seen '
+                                  'by several sources are reported once '
+                                  '(default: auth.log).',
+                                  default=['auth.log'])
+        self.settings.string_list(['interface_kinds'],
+                                  'Kinds of network interfaces whose MACs '
+                                  'identify this host in the server, any of '
+                                  'physical, wireless, bond, bridge and '
+                                  'virtual (default: physical).',
+                                  default=['physical'])
+        self.settings.integer(['registered_macs_ttl'],
+                              'Seconds the MACs known by the server are '
+                              'remembered, requests are only sent for '
+                              'them, 0 to use every MAC (default: 3600).',
+                              default=3600)
+        self.settings.choice(['ops_backend'], ['native', 'cuisine', 'helper'],
+                             'How system operations are made: native calls, '
+                             'shell commands through cuisine or requests to '
+                             'the privileged helper (default: native).')
+        self.settings.string(['helper_socket'],
+                             'Unix socket of the privileged helper (default: '
+                             '/var/run/fog_client_helper.sock).',
+                             default=fog_ops.HELPER_SOCKET)
+        self.settings.string_list(['helper_users'],
+                                  'Users allowed to use the privileged '
+                                  'helper besides root (default: none).',
+                                  default=[])
+        self.settings.boolean(['login_watch'],
+                              'In daemon mode report logins as soon as the '
+                              'login sources change instead of every '
+                              'interval (default: False).',
+                              default=False)
+        self.settings.integer(['login_watch_interval'],
+                              'Minimum seconds between two login reports '
+                              'started by login_watch (default: 5).',
+                              default=5)
 
     def setup_logging(self):
         "Set up logging"
@@ -51,6 +122,39 @@ class FogClientApp(cliapp.Application):
         self.allow_reboot = self.settings["allow_reboot"]
         self.snapin_dir = self.settings["snapin_dir"]
         self.interval = self.settings["interval"]
+        self.catch_up_processes = (self.settings["catch_up_processes"]
+                                   or multiprocessing.cpu_count())
+        if self.settings["multicast_group"]:
+            self.multicast = (self.settings["multicast_group"],
+                              self.settings["multicast_port"],
+                              self.settings["multicast_wait"])
+        else:
+            self.multicast = None
+
+    def new_cycle(self):
+        """Replaces self.context, the host facts shared by the commands
+        run until the next cycle"""
+        if getattr(self, "context", None) is not None:
+            self.context.log_saved()
+        self.context = HostContext(self.settings["fog_host"],
+                                   self.settings["interface_kinds"],
+                                   self.settings["registered_macs_ttl"],
+                                   self.settings["login_sources"])
+        return self.context
+
+    def _cycle(self, commands, arguments):
+        self.new_cycle()
+        for command in commands:
+            command(arguments)
+
+    def process_args(self, args):
+        if self.settings["ops_backend"] == "helper":
+            fog_ops.use("helper", socket_path=self.settings["helper_socket"])
+        else:
+            fog_ops.use(self.settings["ops_backend"])
+        self.new_cycle()
+        cliapp.Application.process_args(self, args)
+        self.context.log_saved()
 
     def cmd_snapins(self, args):
         """Downloads and installs the first snapin waiting in the server
@@ -58,14 +162,20 @@ class FogClientApp(cliapp.Application):
         """
         self._load_settings()
         return [components.snapins(self.fog_host, mac,
-                                   self.snapin_dir, self.allow_reboot)
-                for mac in get_macs()]
+                                   self.snapin_dir, self.allow_reboot,
+                                   self.multicast, self.context)
+                for mac in self.context.macs()]
 
     def cmd_logins(self, args):
         """Sets in server logins and loguts
         """
         self._load_settings()
-        return [components.logins(self.fog_host, mac) for mac in get_macs()]
+        return [components.logins(self.fog_host, mac,
+                                  self.settings["login_concurrency"],
+                                  self.settings["login_compact_window"],
+                                  self.catch_up_processes,
+                                  self.settings["login_sources"])
+                for mac in self.context.macs()]
 
     def cmd_daemon(self, args):
         """Starts the service in daemon mode.
@@ -76,14 +186,39 @@ class FogClientApp(cliapp.Application):
         arguments = [args]
 
         commands = [self.subcommands[index] for index in self.subcommands
-                    if index not in ("all", "daemon", "help", "help-all")]
+                    if index not in ("all", "daemon", "helper", "help",
+                                     "help-all")]
 
         scheduler = Scheduler()
-        for command in commands:
-            scheduler.schedule(command, self.interval, arguments)
+        if self.settings["login_watch"]:
+            try:
+                watcher = login_watcher(self.settings["login_sources"])
+            except (OSError, ValueError) as e:
+                logging.warning("Login sources not watched: %s", e)
+            else:
+                commands.remove(self.subcommands["logins"])
+                scheduler.watch(watcher, self._cycle,
+                                [[self.subcommands["logins"]], arguments],
+                                min_interval=self.settings[
+                                    "login_watch_interval"])
+        scheduler.schedule(self._cycle, self.interval, [commands, arguments])
 
         scheduler.run()
 
+    def cmd_helper(self, args):
+        """Starts the privileged helper, run as root, that makes the
+        system operations of a client using ops_backend = helper.
+        """
+        users = self.settings["helper_users"]
+        try:
+            helper = Helper(self.settings["helper_socket"],
+                            self.settings["snapin_dir"],
+                            [pwd.getpwnam(user).pw_uid for user in users])
+        except (OSError, ValueError) as e:
+            raise cliapp.AppException(str(e))
+        logging.info("Helper listening on %s", self.settings["helper_socket"])
+        helper.serve_forever()
+
     def cmd_all(self, args):
         """Execs all commands.
         """
@@ -95,11 +230,11 @@ class FogClientApp(cliapp.Application):
                 commands = [self.subcommands[index]
                             for index in self.subcommands
                             if index not in (
-                                "all", "daemon", "help", "help-all", "green_fog"
+                                "all", "daemon", "helper", "help", "help-all",
+                                "green_fog"
                             )]
 
-                for command in commands:
-                    command(arguments)
+                self._cycle(commands, arguments)
 
         except filelock.FileLockException:
             print "Locked"
@@ -0,0 +1,160 @@
+"""Privileged helper for fog_client
+
+Runs as root and makes the privileged operations of an unprivileged
+fog_client connected to its unix socket, so the client doesn't spawn sudo
+for each of them. Only the operations in Helper.OPERATIONS are accepted,
+from root or the allowed users, each with its arguments checked.
+
+Snapins are arbitrary programs by design: the helper only runs files of a
+snapin directory owned by root that other users can't write to, with no
+shell and an allowed interpreter given no options of its own, so the
+snapin file is what runs. It does not restrict what snapins do.
+"""
+import json
+import logging
+import os
+import re
+import shlex
+import socket
+import SocketServer
+import stat
+import struct
+import subprocess
+
+from fog_ops import NativeOps
+
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+PEERCRED = struct.Struct("3i")
+
+HOSTNAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9.-]{0,252}$")
+ALLOWED_PROGRAMS = ["install-salt"]
+
+# interpreters a snapin may be run with, by name or from a system directory
+INTERPRETERS = ["sh", "bash", "dash", "python", "python2", "python3", "perl"]
+INTERPRETER_DIRS = ["/bin", "/usr/bin"]
+
+
+def _hostname(host):
+    if not isinstance(host, basestring) or not HOSTNAME_RE.match(host):
+        raise ValueError("Invalid hostname %r" % (host,))
+    return str(host)
+
+
+def _string(value):
+    if not isinstance(value, basestring) or "\n" in value:
+        raise ValueError("Invalid argument %r" % (value,))
+    return str(value)
+
+
+def snapin_command(path, run_with, run_with_args, args):
+    """Returns the argv running the snapin at :path, with the interpreter
+    :run_with if any, followed by :args split as a shell would but never
+    run by one.
+
+    Raises ValueError if :run_with is not an allowed interpreter or
+    :run_with_args is given, interpreter options such as -c could run
+    something else than the snapin.
+    """
+    command = []
+    if run_with:
+        dirname, name = os.path.split(run_with)
+        if (name not in INTERPRETERS
+                or dirname and dirname not in INTERPRETER_DIRS):
+            raise ValueError("Interpreter %r not allowed" % (run_with,))
+        command.append(run_with)
+    if run_with_args.strip():
+        raise ValueError("Interpreter arguments %r not allowed"
+                         % (run_with_args,))
+    return command + [path] + shlex.split(args)
+
+
+class HelperHandler(SocketServer.StreamRequestHandler):
+    """Answers the requests of one client connection, one JSON object per
+    line each way"""
+    def _peer_uid(self):
+        creds = self.request.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                        PEERCRED.size)
+        _, uid, _ = PEERCRED.unpack(creds)
+        return uid
+
+    def handle(self):
+        uid = self._peer_uid()
+        if uid not in self.server.uids:
+            logging.warning("Helper connection from uid %d refused", uid)
+            return
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+                response = {"result": self.server.dispatch(
+                    request.get("op"), request.get("args") or {})}
+            except (ValueError, TypeError, KeyError, AttributeError,
+                    EnvironmentError, subprocess.CalledProcessError) as e:
+                logging.warning("Helper request failed: %s", e)
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+
+
+class Helper(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Listens on :socket_path for the users with :uids, root is always
+    allowed, and runs snapins found in :snapin_dir"""
+    OPERATIONS = ["sethostname", "update_hosts", "execute", "run", "reboot",
+                  "halt"]
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, snapin_dir, uids=()):
+        self.snapin_dir = os.path.realpath(snapin_dir)
+        self.uids = set(uids) | set([0])
+        self._check_snapin_dir()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               HelperHandler)
+        # access is checked with the peer credentials of each connection
+        os.chmod(socket_path, 0o666)
+        self.ops = NativeOps()
+
+    def _check_snapin_dir(self):
+        """Raises ValueError unless the snapin directory is owned by root
+        and only root and its group can write to it"""
+        info = os.stat(self.snapin_dir)
+        if info.st_uid != 0 or info.st_mode & stat.S_IWOTH:
+            raise ValueError("Snapin directory %s must be owned by root and "
+                             "not writable by others" % self.snapin_dir)
+
+    def _snapin(self, filename):
+        self._check_snapin_dir()
+        path = os.path.realpath(_string(filename))
+        if (os.path.dirname(path) != self.snapin_dir
+                or not os.path.isfile(path)):
+            raise ValueError("%s is not a snapin" % filename)
+        info = os.stat(path)
+        if info.st_uid not in self.uids or info.st_mode & stat.S_IWOTH:
+            raise ValueError("%s is not a snapin of an allowed user"
+                             % filename)
+        return path
+
+    def dispatch(self, op, args):
+        """Makes the operation :op with :args, returns its result"""
+        if op not in self.OPERATIONS:
+            raise ValueError("Operation %r not allowed" % (op,))
+        logging.info("Helper %s %s", op, args)
+        if op == "sethostname":
+            return self.ops.set_hostname(_hostname(args["host"]))
+        if op == "update_hosts":
+            return self.ops.update_hosts(_hostname(args["old"]),
+                                         _hostname(args["host"]))
+        if op == "execute":
+            path = self._snapin(args["filename"])
+            command = snapin_command(path, _string(args["run_with"]),
+                                     _string(args["run_with_args"]),
+                                     _string(args["args"]))
+            os.chmod(path, 0o700)
+            return subprocess.call(command)
+        if op == "run":
+            if args["args"] not in [[program] for program in ALLOWED_PROGRAMS]:
+                raise ValueError("Program %r not allowed" % (args["args"],))
+            return self.ops.run([str(args["args"][0])])
+        if op == "reboot":
+            return self.ops.reboot()
+        return self.ops.halt()
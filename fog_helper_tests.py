@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import fog_helper
+import fog_ops
+
+
+class SnapinCommandTests(unittest.TestCase):
+
+    def test_runs_the_snapin_without_interpreter(self):
+        self.assertEqual(fog_helper.snapin_command("/snapins/a", "", "",
+                                                   "-x 'two words'"),
+                         ["/snapins/a", "-x", "two words"])
+
+    def test_runs_the_snapin_with_an_allowed_interpreter(self):
+        self.assertEqual(fog_helper.snapin_command("/snapins/a", "/bin/bash",
+                                                   "", "-e"),
+                         ["/bin/bash", "/snapins/a", "-e"])
+
+    def test_shell_syntax_is_not_interpreted(self):
+        self.assertEqual(fog_helper.snapin_command("/snapins/a", "sh", "",
+                                                   "; rm -rf / $(id)"),
+                         ["sh", "/snapins/a", ";", "rm", "-rf", "/",
+                          "$(id)"])
+
+    def test_other_interpreters_are_refused(self):
+        for run_with in ["rm", "/tmp/bash", "bash -c id", "sh; id"]:
+            self.assertRaises(ValueError, fog_helper.snapin_command,
+                              "/snapins/a", run_with, "", "")
+
+    def test_interpreter_options_are_refused(self):
+        for run_with, run_with_args in [("bash", '-c "id > /root/pwned"'),
+                                        ("python", "-c 'import os'"),
+                                        ("python", "-m SimpleHTTPServer"),
+                                        ("perl", "-e 'system(1)'"),
+                                        ("", "-c id")]:
+            self.assertRaises(ValueError, fog_helper.snapin_command,
+                              "/snapins/a", run_with, run_with_args, "")
+
+
+class NativeExecuteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.snapin = os.path.join(self.dirname, "snapin")
+        with open(self.snapin, "w") as snapin:
+            snapin.write("exit $1\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_native_backend_runs_any_interpreter_through_the_shell(self):
+        self.assertEqual(fog_ops.NativeOps().execute(
+            self.snapin, "/usr/bin/env", "sh", "$((1 + 2))"), 3)
+
+
+class HelperSnapinDirTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.snapin_dir = os.path.join(self.dirname, "snapins")
+        os.mkdir(self.snapin_dir)
+        self.socket_path = os.path.join(self.dirname, "helper.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def helper(self):
+        return fog_helper.Helper(self.socket_path, self.snapin_dir,
+                                 [os.getuid()])
+
+    @unittest.skipIf(os.getuid() != 0, "needs root")
+    def test_refuses_a_snapin_dir_others_can_write(self):
+        os.chmod(self.snapin_dir, 0o1777)
+        self.assertRaises(ValueError, self.helper)
+
+    @unittest.skipIf(os.getuid() != 0, "needs root")
+    def test_refuses_a_snapin_dir_not_owned_by_root(self):
+        os.chown(self.snapin_dir, 65534, 0)
+        self.assertRaises(ValueError, self.helper)
+
+    @unittest.skipIf(os.getuid() != 0, "needs root")
+    def test_refuses_snapins_others_can_write(self):
+        os.chmod(self.snapin_dir, 0o755)
+        helper = self.helper()
+        try:
+            path = os.path.join(self.snapin_dir, "snapin")
+            with open(path, "w") as snapin:
+                snapin.write("#!/bin/sh\n")
+            os.chmod(path, 0o666)
+            self.assertRaises(ValueError, helper._snapin, path)
+            os.chmod(path, 0o644)
+            self.assertEqual(helper._snapin(path), path)
+        finally:
+            helper.server_close()
+
+    @unittest.skipIf(os.getuid() != 0, "needs root")
+    def test_refuses_hostile_interpreter_arguments(self):
+        os.chmod(self.snapin_dir, 0o755)
+        helper = self.helper()
+        try:
+            path = os.path.join(self.snapin_dir, "snapin")
+            pwned = os.path.join(self.dirname, "pwned")
+            with open(path, "w") as snapin:
+                snapin.write("exit 0\n")
+            self.assertRaises(ValueError, helper.dispatch, "execute",
+                              {"filename": path, "run_with": "bash",
+                               "run_with_args": '-c "touch %s"' % pwned,
+                               "args": ""})
+            self.assertFalse(os.path.exists(pwned))
+            self.assertEqual(helper.dispatch("execute",
+                                             {"filename": path,
+                                              "run_with": "sh",
+                                              "run_with_args": "",
+                                              "args": ""}), 0)
+        finally:
+            helper.server_close()
@@ -0,0 +1,128 @@
+"""Minimal inotify bindings used to wake fog_client when files change
+
+Directories are watched instead of the files themselves so log rotation
+(the file being renamed away and created again) keeps being followed
+without having to re-add watches.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+FILE_EVENTS = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE)
+
+EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def _inotify():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+
+class Inotify(object):
+    """Watches files by name inside directories"""
+    def __init__(self):
+        super(Inotify, self).__init__()
+        self.fd = _check(_inotify().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def watch(self, dirname, names=None):
+        """Watches the files :names in :dirname, every file if None"""
+        wd = _check(_inotify().inotify_add_watch(self.fd, dirname,
+                                                 FILE_EVENTS | IN_ONLYDIR))
+        watched = self.watches.setdefault(wd, set())
+        if names is None or None in watched:
+            watched.clear()
+            watched.add(None)
+        else:
+            watched.update(names)
+
+    def read(self):
+        """Returns the names of the watched files changed since last read,
+        an overflowed queue counts as a change of every file"""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return changed
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                watched = self.watches.get(wd)
+                if mask & IN_Q_OVERFLOW:
+                    changed.add(None)
+                elif watched and (None in watched or name in watched):
+                    changed.add(name)
+
+    def wait(self, timeout=None, quiet=0.2, latency=1.0):
+        """Waits up to :timeout seconds for a change and returns the changed
+        names, empty if there was none.
+
+        Once something changes, the burst is collected until no event has
+        arrived for :quiet seconds or :latency seconds have passed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while not changed:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return changed
+            changed = self.read()
+        settled = time.time() + latency
+        while True:
+            remaining = min(quiet, settled - time.time())
+            if remaining <= 0:
+                return changed
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return changed
+            changed.update(self.read())
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
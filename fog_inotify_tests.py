@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fog_inotify import Inotify
+
+
+class InotifyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.inotify = Inotify()
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(self.dirname)
+
+    def write(self, name, contents="line\n"):
+        with open(os.path.join(self.dirname, name), "a") as watched:
+            watched.write(contents)
+
+    def test_reports_the_watched_files_that_change(self):
+        self.inotify.watch(self.dirname, ["auth.log"])
+        self.write("auth.log")
+        self.assertEqual(self.inotify.wait(1), set(["auth.log"]))
+
+    def test_ignores_other_files_of_the_directory(self):
+        self.inotify.watch(self.dirname, ["auth.log"])
+        self.write("syslog")
+        self.assertEqual(self.inotify.wait(0.2), set())
+
+    def test_watches_every_file_without_names(self):
+        self.inotify.watch(self.dirname)
+        self.write("system.journal")
+        self.write("user.journal")
+        self.assertEqual(self.inotify.wait(1),
+                         set(["system.journal", "user.journal"]))
+
+    def test_follows_rotations(self):
+        self.write("auth.log")
+        self.inotify.watch(self.dirname, ["auth.log"])
+        os.rename(os.path.join(self.dirname, "auth.log"),
+                  os.path.join(self.dirname, "auth.log.1"))
+        self.assertEqual(self.inotify.wait(1), set(["auth.log"]))
+        self.write("auth.log")
+        self.assertEqual(self.inotify.wait(1), set(["auth.log"]))
+
+    def test_times_out_when_nothing_changes(self):
+        self.inotify.watch(self.dirname)
+        self.assertEqual(self.inotify.wait(0.1), set())
@@ -1,10 +1,35 @@
 """Utility code for fog_client"""
-import cuisine as c
 import requests
-import re
+import base64
+import binascii
 import logging
 import sched
+import select
+import socket
 import time
+import collections
+import errno
+import itertools
+import json
+import os
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+
+from fog_ops import ops
+from fog_logins import (AUTH_LOG, SessionIndex, reverse_lines, session_logs,
+                        source_readable, state_write)
+
+OUTBOX = "/var/lib/fog_client_linux_outbox"
+REGISTERED_MACS = "/var/lib/fog_client_linux_registered_macs"
+
+MAC_RE = re.compile(r"^[0-9a-f]{2}(?::[0-9a-f]{2}){5}$")
+
+NET_CLASS = "/sys/class/net"
+ARPHRD_ETHER = "1"
+IFF_UP = 0x1
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
 
 
 class FogRequester(object):
@@ -14,11 +39,14 @@ class FogRequester(object):
     """
 
     FOG_OK = "#!ok"
+    FOG_INVALID_HOST = "#!ih"
+    FOG_INVALID_MAC = "#!im"
 
-    def __init__(self, mac, fog_host):
+    def __init__(self, mac, fog_host, outbox=None):
         super(FogRequester, self).__init__()
         self.mac = mac
         self.fog_host = fog_host
+        self.outbox = outbox
 
     def get_data(self, service, binary=False, **kwargs):
         try:
@@ -30,17 +58,309 @@ class FogRequester(object):
                                     params=params)
             if binary:
                 return response.content
+            if response.text.strip().startswith(self.FOG_INVALID_HOST):
+                invalid_hosts.add(self.mac)
             return response.text
         except requests.exceptions.ConnectionError:
             raise IOError("Error communicating with fog server on "
                           + self.fog_host)
 
+    def report(self, **kwargs):
+        """Sends a report to the fog server.
+
+        If the server can't be reached, or older reports are still waiting
+        in the outbox, the report is queued in the outbox and FOG_OK is
+        returned.
+        """
+        if self.outbox is None:
+            return self.get_data(**kwargs)
+        if not self.outbox.pending:
+            try:
+                return self.get_data(**kwargs)
+            except IOError as e:
+                logging.info(e)
+        self.outbox.put(self.fog_host, self.mac, kwargs)
+        return self.FOG_OK
+
+
+class Outbox(object):
+    """Append-only file of the reports the fog server has not received yet.
+
+    Each line is a JSON record, either a report or the acknowledgement of
+    an earlier one. Reports are fsynced every :sync_every records and on
+    sync().
+    """
+    def __init__(self, filename=OUTBOX, sync_every=16):
+        super(Outbox, self).__init__()
+        self.filename = filename
+        self.sync_every = sync_every
+        self.lock = threading.Lock()
+        self.records = 0
+        self.unsynced = 0
+        self.pending = self._load()
+        self.next_id = max(self.pending.keys() or [0]) + 1
+        self.file = None
+
+    def _load(self):
+        pending = collections.OrderedDict()
+        self.torn = False
+        try:
+            with open(self.filename, "r") as outbox:
+                for line in outbox:
+                    self.records += 1
+                    self.torn = not line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "ack" in record:
+                        pending.pop(record["ack"], None)
+                    else:
+                        pending[record["id"]] = record
+        except IOError:
+            pass
+        return pending
+
+    def _append(self, record):
+        if self.file is None:
+            self.file = open(self.filename, "a")
+            if self.torn:
+                self.file.write("\n")
+        self.file.write(json.dumps(record) + "\n")
+        self.records += 1
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self._sync()
+
+    def _sync(self):
+        if self.file is not None and self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def put(self, fog_host, mac, params):
+        """Queues the report :params for :fog_host"""
+        with self.lock:
+            record = {"id": self.next_id, "host": fog_host, "mac": mac,
+                      "params": params}
+            self.next_id += 1
+            self._append(record)
+            self.pending[record["id"]] = record
+
+    def _ack(self, record_id, dropped=None):
+        """Removes report :record_id, delivered or :dropped with the
+        server's answer"""
+        with self.lock:
+            ack = {"ack": record_id}
+            if dropped is not None:
+                ack["dropped"] = dropped
+            self._append(ack)
+            del self.pending[record_id]
+
+    def compact(self):
+        """Rewrites the outbox without the delivered reports"""
+        with self.lock:
+            if self.records == len(self.pending):
+                return
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            state_write(self.filename,
+                        "".join(json.dumps(record) + "\n"
+                                for record in self.pending.values()))
+            self.records = len(self.pending)
+            self.unsynced = 0
+            self.torn = False
+
+    REFUSED = (FogRequester.FOG_INVALID_HOST, FogRequester.FOG_INVALID_MAC)
+
+    def replay(self, concurrency=4):
+        """Sends the queued reports in order, up to :concurrency at once,
+        and stops at the first one the server can't be reached for or
+        answers with anything but FOG_OK, a server fault may be transient.
+        Only the reports refused for good, with an answer in REFUSED, are
+        dropped.
+
+        Returns the number of reports delivered.
+        """
+        records = self.pending.values()
+        if not records:
+            return 0
+
+        def send(record):
+            requester = FogRequester(mac=record["mac"],
+                                     fog_host=record["host"])
+            params = dict((str(key), value)
+                          for key, value in record["params"].items())
+            try:
+                return requester.get_data(**params)
+            except IOError as e:
+                logging.info(e)
+                return None
+
+        delivered = 0
+        pool = ThreadPool(concurrency)
+        try:
+            for record, text in itertools.izip(records,
+                                               pool.imap(send, records)):
+                if text is None:
+                    break
+                answer = text.strip()
+                if answer == FogRequester.FOG_OK:
+                    self._ack(record["id"])
+                    delivered += 1
+                elif answer.startswith(self.REFUSED):
+                    # retrying would not change the answer and would hold
+                    # back every later report
+                    logging.warning("Outbox report %s refused by the "
+                                    "server with %r, dropped",
+                                    record["params"], text[:200])
+                    self._ack(record["id"], dropped=text[:200])
+                else:
+                    logging.info("Outbox report %s answered with %r, kept "
+                                 "for the next replay", record["params"],
+                                 text[:200])
+                    break
+        finally:
+            pool.terminate()
+            self.sync()
+            self.compact()
+        logging.info("Outbox delivered %d of %d reports", delivered,
+                     len(records))
+        return delivered
+
+
+def discover_macs(fog_host, macs, concurrency=4):
+    """Returns which of :macs the fog server knows, None if some of them
+    could not be asked"""
+    def known(mac):
+        fog_server = FogRequester(mac=mac, fog_host=fog_host)
+        try:
+            text = fog_server.get_data(service="hostname")
+        except IOError as e:
+            logging.info(e)
+            return None
+        return not text.strip().startswith(FogRequester.FOG_INVALID_HOST)
+
+    if not macs:
+        return []
+    pool = ThreadPool(min(concurrency, len(macs)))
+    try:
+        answers = pool.map(known, macs)
+    finally:
+        pool.terminate()
+    if None in answers:
+        return None
+    return [mac for mac, answer in zip(macs, answers) if answer]
+
+
+class RegisteredMacs(object):
+    """Remembers which MACs of the host the fog server knows, so commands
+    only send requests for those"""
+    def __init__(self, filename=REGISTERED_MACS):
+        super(RegisteredMacs, self).__init__()
+        self.filename = filename
+        self.state = None
+
+    def _load(self):
+        if self.state is None:
+            try:
+                with open(self.filename, "r") as state_file:
+                    self.state = json.load(state_file)
+            except (IOError, ValueError):
+                self.state = {}
+        return self.state
+
+    def get(self, fog_host, macs, ttl):
+        """Returns the registered MACs among :macs, discovering them again
+        if the last discovery is older than :ttl seconds or was made for
+        other MACs or server.
+
+        Returns every MAC if the server can't be asked.
+        """
+        state = self._load()
+        if (state.get("fog_host") == fog_host
+                and sorted(state.get("candidates", [])) == sorted(macs)
+                and 0 <= time.time() - state.get("time", 0) < ttl):
+            return state["macs"]
+        found = discover_macs(fog_host, macs)
+        if found is None:
+            return macs
+        if not found:
+            # not cached, the host may be registered at any moment
+            logging.warning("No MAC of this host is registered in %s",
+                            fog_host)
+            return found
+        self.state = {"fog_host": fog_host, "candidates": macs,
+                      "macs": found, "time": time.time()}
+        try:
+            state_write(self.filename, json.dumps(self.state))
+        except (IOError, OSError) as e:
+            logging.info(e)
+        return found
+
+    def forget(self, macs):
+        """Forces a new discovery if one of :macs was registered, called
+        when the server stops recognizing them"""
+        known = set(normalize_mac(mac) for mac in self._load().get("macs", ()))
+        rejected = known & set(normalize_mac(mac) for mac in macs)
+        rejected.discard(None)
+        if not rejected:
+            return
+        logging.info("%s no longer registered, rediscovering",
+                     ", ".join(sorted(rejected)))
+        self.state = {}
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+registered = RegisteredMacs()
+
+# MACs the fog server answered FOG_INVALID_HOST for, as they were sent
+invalid_hosts = set()
+
+
+def normalize_mac(mac):
+    """Returns :mac in lowercase colon notation, decoded if it was sent
+    base64 encoded as login reports do, None if it is not a MAC"""
+    mac = mac.strip()
+    if MAC_RE.match(mac.lower()):
+        return mac.lower()
+    try:
+        decoded = base64.b64decode(mac).lower()
+    except (TypeError, binascii.Error):
+        return None
+    return decoded if MAC_RE.match(decoded) else None
+
+
+def host_macs(fog_host, kinds=None, ttl=3600):
+    """Returns the MACs of interfaces of :kinds that the fog server knows,
+    every one of them if :ttl is 0.
+
+    The known MACs are discovered again if the server answered
+    FOG_INVALID_HOST for one of them since the last call.
+    """
+    macs = get_macs(kinds)
+    if not ttl:
+        return macs
+    if invalid_hosts:
+        registered.forget(invalid_hosts)
+        invalid_hosts.clear()
+    return registered.get(fog_host, macs, ttl)
+
 
 class Scheduler(object):
     """Schedules functions per future execution"""
     def __init__(self):
         super(Scheduler, self).__init__()
-        self.scheduler = sched.scheduler(time.time, time.sleep)
+        self.scheduler = sched.scheduler(time.time, self._delay)
+        self.watches = []
 
     def schedule(self, func, interval, args=None, kwargs=None):
         args = args or []
@@ -52,8 +372,47 @@ class Scheduler(object):
         self.scheduler.enter(interval, 1, func_scheduled,
                             (self, func, args, kwargs, interval))
 
+    def watch(self, watcher, func, args=None, kwargs=None, min_interval=0):
+        """Runs func once now and again each time :watcher, an Inotify,
+        sees a change, instead of at a fixed interval, but not sooner than
+        :min_interval seconds after its last run"""
+        watch = {"watcher": watcher, "func": func, "args": args or [],
+                 "kwargs": kwargs or {}, "pending": False, "last": None,
+                 "min_interval": min_interval}
+        self.watches.append(watch)
+        self._enter(watch)
+
+    def _enter(self, watch):
+        def func_watched(watch):
+            watch["pending"] = False
+            watch["last"] = time.time()
+            watch["func"](*watch["args"], **watch["kwargs"])
+        if not watch["pending"]:
+            watch["pending"] = True
+            delay = 0
+            if watch["last"] is not None:
+                delay = max(0, watch["last"] + watch["min_interval"]
+                            - time.time())
+            self.scheduler.enter(delay, 0, func_watched, (watch,))
+
+    def _delay(self, seconds):
+        """Sleeps :seconds, forever if None, waking up early to queue the
+        watched functions whose files changed"""
+        if not self.watches:
+            time.sleep(seconds)
+            return
+        ready, _, _ = select.select([watch["watcher"]
+                                    for watch in self.watches], [], [],
+                                   seconds)
+        for watch in self.watches:
+            if watch["watcher"] in ready and watch["watcher"].wait(0):
+                self._enter(watch)
+
     def run(self):
         self.scheduler.run()
+        while self.watches:
+            self._delay(None)
+            self.scheduler.run()
 
 
 def file_read(filename):
@@ -74,15 +433,8 @@ def file_update(filename, updater):
         f_w.write(updated)
 
 
-def obtain_logins():
-    from logsparser.lognormalizer import LogNormalizer as LN
-
-    normalizer = LN('/usr/local/share/logsparser/normalizers')
-    auth_logs = open('/var/log/auth.log', 'r')
-
-    logs = [{'raw': l} for l in auth_logs]
-    map(normalizer.lognormalize, logs)
-
+def login_events(logs):
+    """Returns the session opens and closes of users in normalized :logs"""
     logins = (log for log in logs
               if log.get('action') == 'open'
               or log.get('action') == 'close')
@@ -94,81 +446,226 @@ def obtain_logins():
     return logins_users
 
 
-def logged_in():
+def obtain_logins(auth_logs=None):
+    """Yields the session opens and closes found in :auth_logs lines,
+    by default the whole /var/log/auth.log.
+
+    Lines are read, filtered and normalized one at a time.
+    """
+    if auth_logs is None:
+        auth_logs = open(AUTH_LOG, 'r')
+
+    return login_events(session_logs(auth_logs))
+
+
+def logged_in(sources=("auth.log",)):
     """Returns True is an user is logged in.
     At the moment only works on Ubuntu 12.04
+
+    Uses the session index fed by the login :sources, or scans auth.log
+    backwards if the index can't be kept. If no source can be read, a user
+    is assumed to be logged in.
     """
+    if not any(source_readable(name) for name in sources):
+        logging.info("No login source readable, assuming logged in")
+        return True
     try:
-        logins_ligthdm = (log for log in obtain_logins()
+        index = SessionIndex(sources=sources)
+        index.refresh()
+        return index.logged_in()
+    except (IOError, OSError) as e:
+        logging.info(e)
+
+    try:
+        logins_ligthdm = (log for log in obtain_logins(reverse_lines(AUTH_LOG))
                           if log.get('program') == 'lightdm'
                           and log.get('user') != 'lightdm')
-        reversed_logins = reversed(list(logins_ligthdm))
-        for log in reversed_logins:
-            if log.get('action') == 'open':
-                return True
-            else:
-                return False
-    except OSError:
+        for log in logins_ligthdm:
+            return log.get('action') == 'open'
+        return False
+    except (IOError, OSError):
         return True
 
 
-def shutdown(mode="reboot", allow_reboot=True):
+def shutdown(mode="reboot", allow_reboot=True, context=None):
     """Shutdowns or reboots the computer if allow reboot == True."""
     allow_reboot=False
-    if logged_in():
+    if (context.logged_in() if context else logged_in()):
         logging.info("Logged in, not rebooting")
         status, reboot = True, False
     else:
         logging.info("Not logged in, rebooting")
         status, reboot = True, True
         if allow_reboot:
-            with c.mode_local():
-                with c.mode_sudo():
-                    if mode == "reboot":
-                        c.run("reboot -f")
-                    else:
-                        c.run("halt")
+            if mode == "reboot":
+                ops().reboot()
+            else:
+                ops().halt()
     return status, reboot
 
 
-def get_macs():
-    """Returns all MAC adresses of the NIC cards installed on the computer"""
-    mac_re = "([a-fA-F0-9]{2}[:|\-]?){6}"
-    mac_re_comp = re.compile(mac_re)
-    with c.mode_local():
-        ifconfig = c.run("ifconfig")
-        macs = (mac_re_comp.search(line).group()
-                for line in ifconfig.splitlines()
-                if 'ether' in line)
-        return macs
+def _link_changes():
+    """Returns a netlink socket receiving a message each time a network
+    interface is added, removed or changed, None if netlink is unavailable"""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_LINK))
+    except (AttributeError, socket.error) as e:
+        logging.info("Network interfaces are not monitored: %s", e)
+        return None
+    sock.setblocking(False)
+    return sock
+
+
+def _links_changed(sock):
+    """Drains :sock and returns whether any interface changed"""
+    changed = False
+    while True:
+        try:
+            if not sock.recv(65536):
+                return changed
+            changed = True
+        except socket.error as e:
+            if e.errno == errno.EAGAIN:
+                return changed
+            # ENOBUFS, messages were lost
+            changed = True
+
+
+def _read_net(name, attribute):
+    with open(os.path.join(NET_CLASS, name, attribute), "r") as net_file:
+        return net_file.read().strip()
+
+
+def interface_kind(name):
+    """Returns the kind of interface :name, as sysfs describes it: bridge,
+    bond, wireless, physical (backed by a device) or virtual"""
+    path = os.path.join(NET_CLASS, name)
+    if os.path.exists(os.path.join(path, "bridge")):
+        return "bridge"
+    if os.path.exists(os.path.join(path, "bonding")):
+        return "bond"
+    if (os.path.exists(os.path.join(path, "wireless"))
+            or os.path.exists(os.path.join(path, "phy80211"))):
+        return "wireless"
+    if os.path.exists(os.path.join(path, "device")):
+        return "physical"
+    return "virtual"
+
+
+def _interfaces():
+    """Returns (name, mac, kind) of the interfaces that are up and
+    ethernet"""
+    interfaces = []
+    for name in sorted(os.listdir(NET_CLASS)):
+        try:
+            if _read_net(name, "type") != ARPHRD_ETHER:
+                continue
+            if not int(_read_net(name, "flags"), 16) & IFF_UP:
+                continue
+            interfaces.append((name, _read_net(name, "address"),
+                               interface_kind(name)))
+        except (IOError, OSError, ValueError):
+            # removed while being read, the next netlink message says so
+            continue
+    return interfaces
+
+
+_interfaces_cache = {}
+
+
+def get_macs(kinds=None):
+    """Returns all MAC adresses of the NIC cards installed on the computer,
+    only of interfaces of :kinds if given (see interface_kind).
+
+    If no interface is of :kinds every MAC is returned, so hosts with an
+    unexpected setup are still identified.
+
+    Read from sysfs and kept until netlink reports an interface change, or
+    for a single call if netlink is unavailable.
+    """
+    if "links" not in _interfaces_cache:
+        _interfaces_cache["links"] = _link_changes()
+    links = _interfaces_cache["links"]
+    if (links is None or _links_changed(links)
+            or "interfaces" not in _interfaces_cache):
+        _interfaces_cache["interfaces"] = _interfaces()
+    interfaces = _interfaces_cache["interfaces"]
+    if kinds is not None:
+        selected = [interface for interface in interfaces
+                    if interface[2] in kinds]
+        if selected or not interfaces:
+            interfaces = selected
+        else:
+            logging.warning("No %s interface, using all of them",
+                            " or ".join(kinds))
+    return [mac for _, mac, _ in interfaces]
+
 
 def get_hostname():
     """Return current hostname"""
-    with c.mode_local():
-        host = c.run("hostname")
-        return host.strip()
+    return ops().hostname()
 
 
 def set_hostname(host):
     """Sets hostname to :host"""
-    def updater(contents):
-        return contents.replace(old, host)
-    with c.mode_local():
-        old = get_hostname()
-        c.run("hostname " + host)
-        file_write("/etc/hostname", host)
-        file_update("/etc/hosts", updater=updater)
-        logging.info("Hostname changed from %s to %s", old, host)
+    old = get_hostname()
+    ops().set_hostname(host)
+    ops().update_hosts(old, host)
+    logging.info("Hostname changed from %s to %s", old, host)
 
 
-def ensure_hostname(host):
+def ensure_hostname(host, context=None):
     "Ensures that hostname is :host"
-    old = get_hostname()
+    old = context.hostname() if context else get_hostname()
     if old != host:
-        with c.mode_sudo():
-            set_hostname(host)
-            c.run("install-salt")
+        set_hostname(host)
+        ops().run(["install-salt"])
+        if context:
+            context.forget("hostname")
         return True, True
     else:
         logging.info("Hostname was not changed")
         return False, False
+
+
+class HostContext(object):
+    """Facts about the host shared by the commands of one cycle, each one
+    computed when first needed and at most once"""
+    def __init__(self, fog_host, kinds=None, ttl=3600,
+                 login_sources=("auth.log",)):
+        super(HostContext, self).__init__()
+        self.fog_host = fog_host
+        self.kinds = kinds
+        self.ttl = ttl
+        self.login_sources = login_sources
+        self.values = {}
+        self.saved = collections.Counter()
+
+    def _get(self, name, compute, *args):
+        if name in self.values:
+            self.saved[name] += 1
+        else:
+            self.values[name] = compute(*args)
+        return self.values[name]
+
+    def forget(self, name):
+        """Computes :name again next time, after changing it"""
+        self.values.pop(name, None)
+
+    def macs(self):
+        return self._get("macs", host_macs, self.fog_host, self.kinds,
+                         self.ttl)
+
+    def logged_in(self):
+        return self._get("logged_in", logged_in, self.login_sources)
+
+    def hostname(self):
+        return self._get("hostname", get_hostname)
+
+    def log_saved(self):
+        if self.saved:
+            logging.debug("Cycle context saved %s calls",
+                          ", ".join("%d %s" % (count, name) for name, count
+                                    in sorted(self.saved.items())))
@@ -0,0 +1,244 @@
+import base64
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import fog_lib
+import fog_logins
+from fog_inotify import Inotify
+
+
+class FakeResponse(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.content = text
+
+
+class OutboxReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "outbox")
+        self.saved_get = fog_lib.requests.get
+        self.answers = {}
+        self.sent = []
+        fog_lib.requests.get = self.get
+
+    def tearDown(self):
+        fog_lib.requests.get = self.saved_get
+        shutil.rmtree(self.dirname)
+
+    def get(self, url, params):
+        self.sent.append(params["n"])
+        answer = self.answers.get(params["n"], "#!ok")
+        if answer is None:
+            raise fog_lib.requests.exceptions.ConnectionError()
+        return FakeResponse(answer)
+
+    def queue(self, count):
+        outbox = fog_lib.Outbox(self.filename)
+        for n in xrange(count):
+            outbox.put("fog", "mac", {"service": "report", "n": n})
+        outbox.sync()
+        return fog_lib.Outbox(self.filename)
+
+    def pending(self):
+        return [record["params"]["n"]
+                for record in fog_lib.Outbox(self.filename).pending.values()]
+
+    def test_delivered_reports_are_removed(self):
+        self.assertEqual(self.queue(3).replay(), 3)
+        self.assertEqual(self.pending(), [])
+
+    def test_refused_reports_are_dropped_not_delivered(self):
+        self.answers[1] = "#!ih"
+        self.answers[2] = "#!im\n"
+        self.assertEqual(self.queue(4).replay(), 2)
+        self.assertEqual(self.pending(), [])
+
+    def test_server_faults_keep_the_reports_queued(self):
+        for answer in ["#!db", "<html>500 Internal Server Error</html>",
+                       "Proxy Error"]:
+            self.answers[1] = answer
+            self.assertEqual(self.queue(3).replay(1), 1)
+            self.assertEqual(self.pending(), [1, 2])
+            os.remove(self.filename)
+
+    def test_replay_stops_at_the_first_unreachable_report(self):
+        self.answers[1] = None
+        self.assertEqual(self.queue(3).replay(1), 1)
+        self.assertEqual(self.pending(), [1, 2])
+
+
+class LoggedInTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.saved = fog_logins.AUTH_LOG, fog_logins.WTMP
+        fog_logins.AUTH_LOG = os.path.join(self.dirname, "auth.log")
+        fog_logins.WTMP = os.path.join(self.dirname, "wtmp")
+
+    def tearDown(self):
+        fog_logins.AUTH_LOG, fog_logins.WTMP = self.saved
+        shutil.rmtree(self.dirname)
+
+    def test_logged_in_when_no_source_is_readable(self):
+        self.assertTrue(fog_lib.logged_in(("auth.log", "wtmp")))
+
+
+class RegisteredMacsTests(unittest.TestCase):
+
+    MACS = ["00:11:22:33:44:55", "66:77:88:99:aa:bb"]
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.saved = fog_lib.requests.get, fog_lib.registered, fog_lib.get_macs
+        self.known = set(self.MACS[:1])
+        self.asked = []
+        fog_lib.requests.get = self.get
+        fog_lib.registered = fog_lib.RegisteredMacs(
+            os.path.join(self.dirname, "registered_macs"))
+        fog_lib.get_macs = lambda kinds=None: list(self.MACS)
+        fog_lib.invalid_hosts.clear()
+
+    def tearDown(self):
+        fog_lib.requests.get, fog_lib.registered, fog_lib.get_macs = self.saved
+        fog_lib.invalid_hosts.clear()
+        shutil.rmtree(self.dirname)
+
+    def get(self, url, params):
+        self.asked.append(params["mac"])
+        mac = fog_lib.normalize_mac(params["mac"])
+        return FakeResponse("#!ok" if mac in self.known else "#!ih")
+
+    def test_normalizes_macs(self):
+        self.assertEqual(fog_lib.normalize_mac("00:11:22:33:44:AA"),
+                         "00:11:22:33:44:aa")
+        self.assertEqual(fog_lib.normalize_mac(
+            base64.b64encode("00:11:22:33:44:aa")), "00:11:22:33:44:aa")
+        self.assertEqual(fog_lib.normalize_mac("not a mac"), None)
+
+    def test_registered_macs_are_cached(self):
+        self.assertEqual(fog_lib.host_macs("fog"), self.MACS[:1])
+        self.assertEqual(fog_lib.host_macs("fog"), self.MACS[:1])
+        self.assertEqual(len(self.asked), 2)
+
+    def test_empty_discovery_is_not_cached(self):
+        self.known = set()
+        self.assertEqual(fog_lib.host_macs("fog"), [])
+        self.known = set(self.MACS[1:])
+        self.assertEqual(fog_lib.host_macs("fog"), self.MACS[1:])
+
+    def test_invalid_host_answer_forces_a_new_discovery(self):
+        fog_lib.host_macs("fog")
+        self.known = set(self.MACS[1:])
+        requester = fog_lib.FogRequester(
+            mac=base64.b64encode(self.MACS[0]), fog_host="fog")
+        requester.get_data(service="usertracking.report")
+        self.assertEqual(fog_lib.host_macs("fog"), self.MACS[1:])
+
+
+class SchedulerWatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.inotify = Inotify()
+        self.inotify.watch(self.dirname, ["auth.log"])
+        self.scheduler = fog_lib.Scheduler()
+        self.runs = []
+
+    def tearDown(self):
+        self.inotify.close()
+        shutil.rmtree(self.dirname)
+
+    def write(self, name):
+        with open(os.path.join(self.dirname, name), "a") as watched:
+            watched.write("line\n")
+
+    def step(self, seconds):
+        """Waits :seconds for changes, running what is due meanwhile"""
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            queue = self.scheduler.scheduler.queue
+            if queue and queue[0].time <= time.time():
+                self.scheduler.scheduler.run()
+                continue
+            until = min([deadline] + [event.time for event in queue[:1]])
+            self.scheduler._delay(max(0, until - time.time()))
+
+    def test_runs_now_and_on_changes_only(self):
+        self.scheduler.watch(self.inotify, self.runs.append, ["run"])
+        self.scheduler.scheduler.run()
+        self.assertEqual(len(self.runs), 1)
+        self.write("syslog")
+        self.step(0.5)
+        self.assertEqual(len(self.runs), 1)
+        self.write("auth.log")
+        self.step(1.5)
+        self.assertEqual(len(self.runs), 2)
+
+    def test_changes_wait_for_the_minimum_interval(self):
+        self.scheduler.watch(self.inotify, self.runs.append, ["run"],
+                             min_interval=2)
+        self.scheduler.scheduler.run()
+        self.write("auth.log")
+        self.write("auth.log")
+        self.step(1.5)
+        self.assertEqual(len(self.runs), 1)
+        self.step(1.0)
+        self.assertEqual(len(self.runs), 2)
+
+
+class SysfsInterfacesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.saved = fog_lib.NET_CLASS, dict(fog_lib._interfaces_cache)
+        fog_lib.NET_CLASS = self.dirname
+        fog_lib._interfaces_cache.clear()
+        # without netlink sysfs is read on every call
+        fog_lib._interfaces_cache["links"] = None
+        self.interface("eth0", "00:11:22:33:44:55", extra="device")
+        self.interface("eth1", "00:11:22:33:44:66", flags="0x1002",
+                       extra="device")
+        self.interface("wlan0", "00:11:22:33:44:77", extra="phy80211")
+        self.interface("br0", "00:11:22:33:44:88", extra="bridge")
+        self.interface("veth0", "00:11:22:33:44:99")
+        self.interface("lo", "00:00:00:00:00:00", kind="772")
+
+    def tearDown(self):
+        fog_lib.NET_CLASS = self.saved[0]
+        fog_lib._interfaces_cache.clear()
+        fog_lib._interfaces_cache.update(self.saved[1])
+        shutil.rmtree(self.dirname)
+
+    def interface(self, name, address, kind="1", flags="0x1003", extra=None):
+        path = os.path.join(self.dirname, name)
+        os.mkdir(path)
+        for attribute, value in [("type", kind), ("flags", flags),
+                                 ("address", address)]:
+            with open(os.path.join(path, attribute), "w") as net_file:
+                net_file.write(value + "\n")
+        if extra:
+            os.mkdir(os.path.join(path, extra))
+
+    def test_reads_the_ethernet_interfaces_that_are_up(self):
+        self.assertEqual(fog_lib._interfaces(),
+                         [("br0", "00:11:22:33:44:88", "bridge"),
+                          ("eth0", "00:11:22:33:44:55", "physical"),
+                          ("veth0", "00:11:22:33:44:99", "virtual"),
+                          ("wlan0", "00:11:22:33:44:77", "wireless")])
+
+    def test_selects_the_macs_of_kinds(self):
+        self.assertEqual(fog_lib.get_macs(["physical", "wireless"]),
+                         ["00:11:22:33:44:55", "00:11:22:33:44:77"])
+
+    def test_falls_back_to_every_mac_without_interfaces_of_kinds(self):
+        self.assertEqual(len(fog_lib.get_macs(["bond"])), 4)
+
+    def test_skips_interfaces_removed_while_read(self):
+        os.remove(os.path.join(self.dirname, "eth0", "address"))
+        self.assertFalse("00:11:22:33:44:55" in fog_lib.get_macs())
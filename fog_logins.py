@@ -0,0 +1,849 @@
+"""Login event sources for fog_client"""
+import datetime
+import gzip
+import heapq
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+import subprocess
+
+from fog_inotify import Inotify
+
+AUTH_LOG = "/var/log/auth.log"
+AUTH_LOG_STATE = "/var/lib/fog_client_linux_auth_log"
+NORMALIZERS_DIR = "/usr/local/share/logsparser/normalizers"
+
+SESSIONS_STATE = "/var/lib/fog_client_linux_sessions"
+SESSIONS_AUTH_LOG_STATE = "/var/lib/fog_client_linux_sessions_auth_log"
+SESSIONS_WTMP_STATE = "/var/lib/fog_client_linux_sessions_wtmp"
+SESSIONS_JOURNAL_STATE = "/var/lib/fog_client_linux_sessions_journal"
+
+WTMP = "/var/log/wtmp"
+WTMP_STATE = "/var/lib/fog_client_linux_wtmp"
+
+JOURNAL_STATE = "/var/lib/fog_client_linux_journal"
+JOURNAL_IDENTIFIERS = ["lightdm", "sshd", "login"]
+JOURNAL_DIRS = ["/run/log/journal", "/var/log/journal"]
+
+CATCH_UP_BYTES = 32 * 1024 * 1024
+
+# seeking by date stops once the range is this small, and goes back this
+# far because syslog lines are only roughly in date order
+SEEK_RANGE_BYTES = 64 * 1024
+SEEK_SLACK = datetime.timedelta(minutes=5)
+
+SESSION_MESSAGE = (r"pam_unix\([^)]*:session\): session "
+                   r"(?P<action>open|close)e?d for user (?P<user>[^\s(]+)")
+
+SYSLOG_DATE = (r"^(?P<month>[A-Z][a-z]{2}) +(?P<day>\d{1,2}) "
+               r"(?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d) ")
+
+SESSION_RE = re.compile(
+    SYSLOG_DATE + r"\S+ (?P<program>[^\s\[:]+)(?:\[\d+\])?: " +
+    SESSION_MESSAGE)
+
+SYSLOG_DATE_RE = re.compile(SYSLOG_DATE)
+
+SESSION_MESSAGE_RE = re.compile(SESSION_MESSAGE)
+
+MONTHS = dict((month, number) for number, month in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], 1))
+
+
+_normalizers = {}
+
+
+def _tree_mtimes(dirname):
+    """Returns the modification times of :dirname and everything in it"""
+    mtimes = []
+    for root, _, files in os.walk(dirname):
+        for name in [root] + [os.path.join(root, f) for f in files]:
+            mtimes.append((name, os.stat(name).st_mtime))
+    return sorted(mtimes)
+
+
+def get_normalizer(dirname=NORMALIZERS_DIR):
+    """Returns a logsparser LogNormalizer for :dirname.
+
+    It is built once per process and built again only when a file in
+    :dirname changes.
+    """
+    mtimes = _tree_mtimes(dirname)
+    cached = _normalizers.get(dirname)
+    if cached is None or cached[0] != mtimes:
+        from logsparser.lognormalizer import LogNormalizer
+        cached = mtimes, LogNormalizer(dirname)
+        _normalizers[dirname] = cached
+    return cached[1]
+
+
+def is_session_line(line):
+    """Cheap check for lines that may hold a session open or close"""
+    return "session opened" in line or "session closed" in line
+
+
+def _syslog_date(match, now=None):
+    """Returns the date matched by SYSLOG_DATE, or None if it is invalid"""
+    if match.group("month") not in MONTHS:
+        return None
+    fields = (MONTHS[match.group("month")], int(match.group("day")),
+              int(match.group("hour")), int(match.group("minute")),
+              int(match.group("second")))
+    now = now or datetime.datetime.now()
+    bound = now + datetime.timedelta(minutes=1)
+    # syslog dates have no year, same guess as logsparser
+    year = now.year
+    if bound.year == year and fields > (bound.month, bound.day, bound.hour,
+                                        bound.minute, bound.second):
+        year -= 1
+    try:
+        return datetime.datetime(year, *fields)
+    except ValueError:
+        # Feb 29 out of a leap year
+        return None
+
+
+def parse_session_line(line):
+    """Returns the pam_unix session open or close in syslog :line as a dict
+    with the keys logsparser would fill, or None if :line has another
+    format"""
+    match = SESSION_RE.match(line)
+    if match is None:
+        return None
+    date = _syslog_date(match)
+    if date is None:
+        return None
+    return {"raw": line,
+            "date": date,
+            "program": match.group("program").lower(),
+            "user": match.group("user"),
+            "action": match.group("action")}
+
+
+def state_write(filename, contents):
+    """Replaces :filename with :contents atomically"""
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as tmp_file:
+        tmp_file.write(contents)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.rename(tmp_filename, filename)
+
+
+def session_logs(lines):
+    """Yields the normalized logs of the session lines in :lines, one at a
+    time"""
+    normalizer = None
+    for line in lines:
+        if not is_session_line(line):
+            continue
+        log = parse_session_line(line)
+        if log is None:
+            if normalizer is None:
+                normalizer = get_normalizer()
+            log = {"raw": line}
+            normalizer.lognormalize(log)
+        yield log
+
+
+def reverse_lines(filename, block_size=64 * 1024):
+    """Yields the lines of :filename starting with the last one"""
+    with open(filename, "rb") as log:
+        log.seek(0, os.SEEK_END)
+        position = log.tell()
+        head = ""
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            log.seek(position)
+            lines = (log.read(size) + head).split("\n")
+            head = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line + "\n"
+        if head:
+            yield head + "\n"
+
+
+def seek_date(filename, since, start, end):
+    """Returns the offset of a line of :filename between :start and :end
+    that is a little older than the first line dated after :since.
+
+    Bisects byte offsets, moving each one to the next line boundary and
+    comparing the date of the first line found there.
+    """
+    if since < datetime.datetime.min + SEEK_SLACK:
+        # nothing was read yet, every line is wanted
+        return start
+    with open(filename, "rb") as log:
+        low, high = start, end
+        while high - low > SEEK_RANGE_BYTES:
+            middle = (low + high) // 2
+            log.seek(middle)
+            log.readline()
+            date = None
+            while date is None and log.tell() < high:
+                match = SYSLOG_DATE_RE.match(log.readline())
+                if match is not None:
+                    date = _syslog_date(match)
+            if date is not None and date < since - SEEK_SLACK:
+                low = middle
+            else:
+                high = middle
+        if low > start:
+            log.seek(low)
+            log.readline()
+            low = log.tell()
+    return low
+
+
+def _line_end(filename, start, end, block_size=64 * 1024):
+    """Returns the offset right after the last newline of :filename between
+    :start and :end, or :start if there is none"""
+    with open(filename, "rb") as log:
+        position = end
+        while position > start:
+            size = min(block_size, position - start)
+            position -= size
+            log.seek(position)
+            newline = log.read(size).rfind("\n")
+            if newline != -1:
+                return position + newline + 1
+    return start
+
+
+def _chunk_session_logs(chunk):
+    """Returns the session logs of the lines starting between :start and
+    :end of :filename"""
+    filename, start, end = chunk
+
+    def chunk_lines(log):
+        position = log.tell()
+        while position < end:
+            line = log.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+    with open(filename, "rb") as log:
+        if start > 0:
+            log.seek(start - 1)
+            if log.read(1) != "\n":
+                log.readline()
+        return list(session_logs(chunk_lines(log)))
+
+
+def parallel_session_logs(filename, start, end, processes, chunk_size=None):
+    """Yields the session logs between the line boundaries :start and :end
+    of :filename, normalized by :processes worker processes in chunks of
+    :chunk_size bytes, by default four chunks per process"""
+    chunks = processes * 4
+    size = chunk_size or (end - start + chunks - 1) // chunks
+    bounds = [(filename, offset, min(offset + size, end))
+              for offset in xrange(start, end, size)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for log in itertools.chain.from_iterable(
+                pool.imap(_chunk_session_logs, bounds)):
+            yield log
+    finally:
+        pool.terminate()
+
+
+class AuthLogReader(object):
+    """Reads auth.log lines starting where the last committed read stopped.
+
+    The position is saved as the inode and byte offset of the log, and
+    whether it was compressed. Rotated logs (auth.log.1, auth.log.N.gz) are
+    followed in order, so the lines written just before a rotation are not
+    lost.
+    """
+    def __init__(self, filename=AUTH_LOG, state_filename=AUTH_LOG_STATE,
+                 processes=1):
+        super(AuthLogReader, self).__init__()
+        self.filename = filename
+        self.state_filename = state_filename
+        self.processes = processes
+        self.inode, self.offset, self.compressed = self._load_state()
+
+    def reset(self):
+        """Forgets the saved position"""
+        self.inode, self.offset, self.compressed = None, 0, False
+
+    def _load_state(self):
+        try:
+            with open(self.state_filename, "r") as state_file:
+                fields = state_file.read().split()
+                inode, offset = int(fields[0]), int(fields[1])
+                return inode, offset, fields[2:] == ["gz"]
+        except (IOError, ValueError, IndexError):
+            return None, 0, False
+
+    def _segments(self):
+        """Returns (filename, stat) of the rotated logs and the current one,
+        oldest first"""
+        dirname, basename = os.path.split(self.filename)
+        rotated_re = re.compile(re.escape(basename) + r"\.(\d+)(\.gz)?$")
+        rotated = []
+        for name in os.listdir(dirname or "."):
+            match = rotated_re.match(name)
+            if match:
+                rotated.append((int(match.group(1)),
+                                os.path.join(dirname, name)))
+        filenames = [filename for _, filename in sorted(rotated, reverse=True)]
+        if os.path.exists(self.filename):
+            filenames.append(self.filename)
+        return [(filename, os.stat(filename)) for filename in filenames]
+
+    def _start(self, segments, since):
+        """Returns the index of the segment and the offset to start from.
+
+        Without a saved position, reading starts in the oldest segment
+        modified after :since, near the lines dated after :since.
+        """
+        inodes = [stat.st_ino for _, stat in segments]
+        if self.inode in inodes:
+            index = inodes.index(self.inode)
+            filename, stat = segments[index]
+            compressed = filename.endswith(".gz")
+            # compressing a log makes a new file, a plain log position
+            # matching a .gz is a reused inode
+            if compressed == self.compressed and (
+                    compressed or stat.st_size >= self.offset):
+                return index, self.offset
+        if since is not None:
+            for index, (filename, stat) in enumerate(segments):
+                if datetime.datetime.fromtimestamp(stat.st_mtime) >= since:
+                    if filename.endswith(".gz"):
+                        return index, 0
+                    return index, seek_date(filename, since, 0,
+                                            stat.st_size)
+            return len(segments), 0
+        return 0, 0
+
+    def _pending(self, since):
+        """Yields (filename, size) of the segments left to read, moving the
+        position to the start of each one.
+
+        If the saved position is lost, only the segments modified after
+        :since are read.
+        """
+        segments = self._segments()
+        start, offset = self._start(segments, since)
+
+        for filename, stat in segments[start:]:
+            self.inode, self.offset = stat.st_ino, offset
+            self.compressed = filename.endswith(".gz")
+            yield filename, stat.st_size
+            offset = 0
+
+    def _segment_lines(self, filename):
+        """Yields the complete lines of :filename from the position on"""
+        opener = gzip.open if filename.endswith(".gz") else open
+        log = opener(filename, "rb")
+        try:
+            log.seek(self.offset)
+            while True:
+                line = log.readline()
+                if not line.endswith("\n"):
+                    break
+                self.offset += len(line)
+                yield line
+        finally:
+            log.close()
+
+    def lines(self, since=None):
+        """Yields the complete lines appended since the saved position"""
+        for filename, _ in self._pending(since):
+            for line in self._segment_lines(filename):
+                yield line
+
+    def session_logs(self, since=None):
+        """Yields the session logs appended since the saved position.
+
+        Plain segments with more than CATCH_UP_BYTES pending are normalized
+        by self.processes worker processes, in chunks merged back in log
+        order.
+        """
+        for filename, size in self._pending(since):
+            if (self.processes > 1 and not filename.endswith(".gz")
+                    and size - self.offset > CATCH_UP_BYTES):
+                end = _line_end(filename, self.offset, size)
+                for log in parallel_session_logs(filename, self.offset, end,
+                                                 self.processes):
+                    yield log
+                self.offset = end
+            for log in session_logs(self._segment_lines(filename)):
+                yield log
+
+    def commit(self):
+        """Saves the position reached by lines()"""
+        if self.inode is not None:
+            state_write(self.state_filename,
+                        "{} {}{}".format(self.inode, self.offset,
+                                         " gz" if self.compressed else ""))
+
+
+def _boot():
+    """Returns the boot id and the boot time of the running system"""
+    with open("/proc/sys/kernel/random/boot_id", "r") as boot_id_file:
+        boot_id = boot_id_file.read().strip()
+    with open("/proc/stat", "r") as stat_file:
+        for line in stat_file:
+            if line.startswith("btime "):
+                boot_time = int(line.split()[1])
+    return boot_id, datetime.datetime.fromtimestamp(boot_time)
+
+
+class SessionIndex(object):
+    """Last session action of every user, per program, kept up to date by
+    reading only the session logs of the login :sources written since the
+    previous refresh.
+
+    The index keeps its own reader positions, apart from the ones of the
+    logins reported to the server, and starts empty on every boot, reading
+    from the logs dated after the boot time.
+    """
+    def __init__(self, filename=SESSIONS_STATE, sources=("auth.log",),
+                 reader=None):
+        super(SessionIndex, self).__init__()
+        self.filename = filename
+        self.sources = list(sources)
+        self.reader = reader or login_sources(
+            self.sources, states=SESSIONS_SOURCE_STATES)
+        self.boot_id, self.sessions = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.filename, "r") as state_file:
+                state = json.load(state_file)
+                if state.get("sources", ["auth.log"]) != self.sources:
+                    return None, {}
+                return state["boot_id"], state["sessions"]
+        except (IOError, ValueError, KeyError):
+            return None, {}
+
+    def refresh(self):
+        """Applies the session logs written since the last refresh and
+        saves the index"""
+        boot_id, boot_time = _boot()
+        if boot_id != self.boot_id:
+            self.boot_id, self.sessions = boot_id, {}
+            self.reader.reset()
+        for log in self.reader.session_logs(since=boot_time):
+            if log.get("date") is not None and log["date"] < boot_time:
+                continue
+            if log.get("action") in ("open", "close"):
+                users = self.sessions.setdefault(log.get("program"), {})
+                users[log.get("user")] = log["action"]
+        state_write(self.filename, json.dumps({"boot_id": self.boot_id,
+                                               "sources": self.sources,
+                                               "sessions": self.sessions}))
+        self.reader.commit()
+
+    def logged_in(self, program="lightdm"):
+        """Returns True if a user other than :program itself has a session
+        of :program open"""
+        users = self.sessions.get(program, {})
+        return any(action == "open" for user, action in users.items()
+                   if user != program)
+
+
+class WtmpReader(object):
+    """Reads session opens and closes from the wtmp records written after
+    the last committed one.
+
+    The saved state holds the inode of the file being read, the index of
+    its next record and the sessions still open, needed to know whose
+    session a DEAD_PROCESS record closes.
+    """
+    # struct utmp on Linux is 384 bytes: type, pid, line, id, user, then
+    # host at 76 and tv_sec at 340. Only the fields used are decoded.
+    RECORD_SIZE = 384
+    HEAD = struct.Struct("<hxxi32s4s32s")
+    SECONDS = struct.Struct("<i")
+    USER_PROCESS = 7
+    DEAD_PROCESS = 8
+
+    def __init__(self, filename=WTMP, state_filename=WTMP_STATE):
+        super(WtmpReader, self).__init__()
+        self.filename = filename
+        self.state_filename = state_filename
+        self.inode, self.index, self.sessions = self._load_state()
+
+    def reset(self):
+        """Forgets the saved index and open sessions"""
+        self.inode, self.index, self.sessions = None, 0, {}
+
+    def _load_state(self):
+        try:
+            with open(self.state_filename, "r") as state_file:
+                state = json.load(state_file)
+                return state["inode"], state["index"], state["sessions"]
+        except (IOError, ValueError, KeyError):
+            return None, 0, {}
+
+    def _pending(self):
+        """Returns (filename, stat) of the rotated wtmp.1 and of wtmp left
+        to read, moving the index to the start of the first one.
+
+        The sessions are kept across a rotation, so the closes of sessions
+        opened in the rotated file are still known.
+        """
+        segments = []
+        for filename in [self.filename + ".1", self.filename]:
+            try:
+                segments.append((filename, os.stat(filename)))
+            except OSError:
+                pass
+        inodes = [stat.st_ino for _, stat in segments]
+        if self.inode not in inodes:
+            self.index = 0
+            return segments[-1:]
+        start = inodes.index(self.inode)
+        if segments[start][1].st_size < self.index * self.RECORD_SIZE:
+            self.index = 0
+        return segments[start:]
+
+    def session_logs(self, since=None):
+        """Yields the session logs of the records after the saved index,
+        finishing the rotated wtmp.1 first if it was being read"""
+        for number, (filename, stat) in enumerate(self._pending()):
+            if number:
+                self.index = 0
+            self.inode = stat.st_ino
+            for log in self._records(filename):
+                yield log
+
+    def _records(self, filename):
+        """Yields the session logs of the records of :filename from the
+        index on"""
+        try:
+            wtmp = open(filename, "rb")
+        except IOError:
+            return
+        with wtmp:
+            stat = os.fstat(wtmp.fileno())
+            size = self.RECORD_SIZE
+            end = stat.st_size - stat.st_size % size
+            if end <= self.index * size:
+                return
+            records = mmap.mmap(wtmp.fileno(), end, access=mmap.ACCESS_READ)
+            head, seconds = self.HEAD.unpack_from, self.SECONDS.unpack_from
+            user_process, dead_process = self.USER_PROCESS, self.DEAD_PROCESS
+            sessions = self.sessions
+            try:
+                for offset in xrange(self.index * size, end, size):
+                    kind, _, line, _, user = head(records, offset)
+                    if kind == user_process:
+                        # lightdm uses the X display as line, remote
+                        # sessions have a host that is not a display
+                        host = records[offset + 76]
+                        if line[0] == ":":
+                            program = "lightdm"
+                        elif host != "\0" and host != ":":
+                            program = "sshd"
+                        elif line.startswith("tty"):
+                            program = "login"
+                        else:
+                            continue
+                        user = user.rstrip("\0")
+                        sessions[line.rstrip("\0")] = user, program
+                        action = "open"
+                    elif kind == dead_process:
+                        line = line.rstrip("\0")
+                        if line not in sessions:
+                            continue
+                        user, program = sessions.pop(line)
+                        action = "close"
+                    else:
+                        continue
+                    self.index = offset // size + 1
+                    date = datetime.datetime.fromtimestamp(
+                        seconds(records, offset + 340)[0])
+                    yield {"date": date,
+                           "user": user,
+                           "program": program,
+                           "action": action}
+                self.index = end // size
+            finally:
+                records.close()
+
+    def commit(self):
+        """Saves the index reached by session_logs()"""
+        if self.inode is not None:
+            state_write(self.state_filename,
+                        json.dumps({"inode": self.inode,
+                                    "index": self.index,
+                                    "sessions": self.sessions}))
+
+
+def _export_entries(stream, line):
+    """Yields the entries of a journal export format :stream, whose first
+    :line has already been read, as dicts"""
+    entry = {}
+    while line:
+        if line == "\n":
+            if entry:
+                yield entry
+                entry = {}
+        elif "=" in line:
+            key, value = line[:-1].split("=", 1)
+            entry[key] = value
+        else:
+            # binary field: name, little endian 64 bit size, data, newline
+            size, = struct.unpack("<Q", stream.read(8))
+            entry[line[:-1]] = stream.read(size)
+            stream.read(1)
+        line = stream.readline()
+    if entry:
+        yield entry
+
+
+def journal_entries(stream):
+    """Yields the entries of :stream, in journal JSON or export format"""
+    first = stream.readline()
+    if not first.startswith("{"):
+        return _export_entries(stream, first)
+    return (json.loads(line) for line in itertools.chain([first], stream)
+            if line.strip())
+
+
+class JournalReader(object):
+    """Reads session opens and closes from the systemd journal, starting
+    after the cursor of the last committed entry.
+
+    Entries come from journalctl, filtered to JOURNAL_IDENTIFIERS, or from
+    :filename, a recorded journal in export or JSON format.
+    """
+    def __init__(self, filename=None, state_filename=JOURNAL_STATE):
+        super(JournalReader, self).__init__()
+        self.filename = filename
+        self.state_filename = state_filename
+        self.cursor = self._load_state()
+
+    def reset(self):
+        """Forgets the saved cursor"""
+        self.cursor = None
+
+    def _load_state(self):
+        try:
+            with open(self.state_filename, "r") as state_file:
+                return state_file.read().strip() or None
+        except IOError:
+            return None
+
+    def _entries(self):
+        if self.filename is not None:
+            with open(self.filename, "rb") as recorded:
+                entries = journal_entries(recorded)
+                if self.cursor is not None:
+                    entries = list(entries)
+                    cursors = [entry.get("__CURSOR") for entry in entries]
+                    if self.cursor in cursors:
+                        entries = entries[cursors.index(self.cursor) + 1:]
+                for entry in entries:
+                    yield entry
+            return
+
+        command = ["journalctl", "--no-pager", "-o", "json"]
+        if self.cursor is not None:
+            command.append("--after-cursor=" + self.cursor)
+        command += ["SYSLOG_IDENTIFIER=" + identifier
+                    for identifier in JOURNAL_IDENTIFIERS]
+        try:
+            journalctl = subprocess.Popen(command, stdout=subprocess.PIPE)
+        except OSError:
+            return
+        try:
+            for entry in journal_entries(journalctl.stdout):
+                yield entry
+        finally:
+            journalctl.stdout.close()
+            journalctl.wait()
+
+    def session_logs(self, since=None):
+        """Yields the session logs of the entries after the saved cursor"""
+        for entry in self._entries():
+            self.cursor = entry.get("__CURSOR", self.cursor)
+            message = entry.get("MESSAGE")
+            if isinstance(message, list):
+                # binary field in journal JSON, an array of bytes
+                message = "".join(chr(byte) for byte in message)
+            if not isinstance(message, basestring):
+                continue
+            match = SESSION_MESSAGE_RE.search(message)
+            if match is None:
+                continue
+            timestamp = int(entry["__REALTIME_TIMESTAMP"]) // 1000000
+            yield {"raw": message,
+                   "date": datetime.datetime.fromtimestamp(timestamp),
+                   "program": entry.get("SYSLOG_IDENTIFIER", "").lower(),
+                   "user": match.group("user"),
+                   "action": match.group("action")}
+
+    def commit(self):
+        """Saves the cursor reached by session_logs()"""
+        if self.cursor is not None:
+            state_write(self.state_filename, self.cursor)
+
+
+class MergedReader(object):
+    """Merges the session logs of several :readers in date order.
+
+    A session event already yielded from another reader, with the same
+    user and action and a date at most :window seconds apart, is dropped.
+    Every reader keeps and commits its own position.
+    """
+    def __init__(self, readers, window=2):
+        super(MergedReader, self).__init__()
+        self.readers = readers
+        self.window = datetime.timedelta(seconds=window)
+
+    def session_logs(self, since=None):
+        """Yields the session logs of all readers, oldest first"""
+        def stream(index, reader):
+            for number, log in enumerate(reader.session_logs(since)):
+                yield log["date"], index, number, log
+
+        streams = [stream(index, reader)
+                   for index, reader in enumerate(self.readers)]
+        seen = {}
+        for date, index, _, log in heapq.merge(*streams):
+            key = log.get("user"), log.get("action")
+            if key in seen:
+                seen_date, seen_index = seen[key]
+                if seen_index != index and date - seen_date <= self.window:
+                    continue
+            seen[key] = date, index
+            yield log
+
+    def reset(self):
+        for reader in self.readers:
+            reader.reset()
+
+    def commit(self):
+        for reader in self.readers:
+            reader.commit()
+
+
+SOURCE_STATES = {"auth.log": AUTH_LOG_STATE,
+                 "wtmp": WTMP_STATE,
+                 "journal": JOURNAL_STATE}
+
+SESSIONS_SOURCE_STATES = {"auth.log": SESSIONS_AUTH_LOG_STATE,
+                          "wtmp": SESSIONS_WTMP_STATE,
+                          "journal": SESSIONS_JOURNAL_STATE}
+
+
+def login_source(name, processes=1, states=SOURCE_STATES):
+    """Returns the reader for the login source :name: auth.log, wtmp or
+    journal, saving its position in the file :states gives for :name"""
+    if name == "auth.log":
+        return AuthLogReader(state_filename=states[name],
+                             processes=processes)
+    if name == "wtmp":
+        return WtmpReader(state_filename=states[name])
+    if name == "journal":
+        return JournalReader(state_filename=states[name])
+    raise ValueError("Unknown login source " + name)
+
+
+def login_sources(names, processes=1, states=SOURCE_STATES):
+    """Returns a reader for the login sources :names, merged if there is
+    more than one"""
+    readers = [login_source(name, processes, states) for name in names]
+    if len(readers) == 1:
+        return readers[0]
+    return MergedReader(readers)
+
+
+def _source_files(name):
+    """Returns (directory, names) pairs holding the files of the login
+    source :name, names is None for every file of the directory"""
+    if name == "auth.log":
+        return [os.path.split(AUTH_LOG)]
+    if name == "wtmp":
+        return [os.path.split(WTMP)]
+    if name == "journal":
+        return [(os.path.join(journal_dir, machine), None)
+                for journal_dir in JOURNAL_DIRS
+                if os.path.isdir(journal_dir)
+                for machine in os.listdir(journal_dir)
+                if os.path.isdir(os.path.join(journal_dir, machine))]
+    raise ValueError("Unknown login source " + name)
+
+
+def source_readable(name):
+    """Returns True if the files of the login source :name can be read"""
+    if name == "journal":
+        return any(os.access(dirname, os.R_OK | os.X_OK)
+                   for dirname, _ in _source_files(name))
+    return all(os.access(os.path.join(dirname, filename), os.R_OK)
+               for dirname, filename in _source_files(name))
+
+
+def journal_cursor():
+    """Returns the cursor of the last journal entry of JOURNAL_IDENTIFIERS,
+    None if there is none or journalctl can't be run"""
+    command = ["journalctl", "--no-pager", "-o", "json", "-n", "1"]
+    command += ["SYSLOG_IDENTIFIER=" + identifier
+                for identifier in JOURNAL_IDENTIFIERS]
+    try:
+        output = subprocess.check_output(command)
+        for line in output.splitlines():
+            if line.strip():
+                return json.loads(line).get("__CURSOR")
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        pass
+    return None
+
+
+class LoginWatcher(Inotify):
+    """Watches the files of the login sources :names, rotations included.
+
+    Journal files change with every message logged, fog_client's own
+    included, so a change of them only counts if the journal has a new
+    entry of JOURNAL_IDENTIFIERS.
+    """
+    def __init__(self, names):
+        super(LoginWatcher, self).__init__()
+        self.journal = "journal" in names
+        self.files = set()
+        try:
+            for name in names:
+                for dirname, filename in _source_files(name):
+                    self.watch(dirname, filename and [filename])
+                    self.files.add(filename)
+        except Exception:
+            self.close()
+            raise
+        self.files.discard(None)
+        self.cursor = journal_cursor() if self.journal else None
+
+    def wait(self, timeout=None, quiet=0.2, latency=1.0):
+        """Returns the changed names as Inotify.wait does, empty also if
+        only journal files changed without a new login related entry"""
+        changed = super(LoginWatcher, self).wait(timeout, quiet, latency)
+        if (not self.journal or not changed or None in changed
+                or changed & self.files):
+            return changed
+        cursor = journal_cursor()
+        if cursor == self.cursor:
+            return set()
+        self.cursor = cursor
+        return changed
+
+
+def login_watcher(names):
+    """Returns a LoginWatcher of the login sources :names.
+
+    Raises OSError if inotify is not available.
+    """
+    return LoginWatcher(names)
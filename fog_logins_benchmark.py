@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Benchmark of auth.log session parsing
+
+Writes a synthetic auth.log and times fog_logins.session_logs against
+normalizing every line with logsparser, as obtain_logins used to, checking
+that both find the same events. The logsparser run is skipped if it is not
+installed.
+
+Usage: fog_logins_benchmark.py [lines] [session share]
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+import fog_logins
+
+NOISE = [
+    "CRON[%(pid)d]: pam_unix(cron:session): session opened for user root "
+    "by (uid=0)",
+    "sshd[%(pid)d]: Accepted publickey for %(user)s from 10.0.0.%(n)d port "
+    "%(pid)d ssh2",
+    "systemd-logind[%(pid)d]: New session %(pid)d of user %(user)s.",
+    "sudo:   %(user)s : TTY=pts/0 ; PWD=/home/%(user)s ; USER=root ; "
+    "COMMAND=/bin/true",
+]
+SESSIONS = [
+    "lightdm: pam_unix(lightdm:session): session %(action)s for user "
+    "%(user)s",
+    "sshd[%(pid)d]: pam_unix(sshd:session): session %(action)s for user "
+    "%(user)s",
+    "login[%(pid)d]: pam_unix(login:session): session %(action)s for user "
+    "%(user)s",
+]
+
+
+def write_log(filename, lines, share):
+    date = datetime.datetime.now() - datetime.timedelta(seconds=lines)
+    with open(filename, "w") as log:
+        for number in xrange(lines):
+            fields = {"pid": random.randint(100, 30000),
+                      "n": random.randint(1, 254),
+                      "user": random.choice(["alice", "bob", "carol"]),
+                      "action": random.choice(["opened", "closed"])}
+            if random.random() < share:
+                message = random.choice(SESSIONS) % fields
+            else:
+                message = random.choice(NOISE) % fields
+            date += datetime.timedelta(seconds=1)
+            log.write("%s host %s\n" % (date.strftime("%b %d %H:%M:%S"),
+                                        message))
+
+
+def events(logs):
+    return [(log.get("date"), log.get("program"), log.get("user"),
+             log.get("action"))
+            for log in logs if log.get("action") in ("open", "close")]
+
+
+def logsparser_logs(filename):
+    normalizer = fog_logins.get_normalizer()
+    with open(filename, "r") as log:
+        for line in log:
+            normalized = {"raw": line}
+            normalizer.lognormalize(normalized)
+            yield normalized
+
+
+def timed(name, logs):
+    start = time.time()
+    found = events(logs)
+    print "%-28s %8.2fs %8d events" % (name, time.time() - start, len(found))
+    return found
+
+
+def main(args):
+    lines = int(args[0]) if args else 1000000
+    share = float(args[1]) if len(args) > 1 else 0.4
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        write_log(filename, lines, share)
+        print "%d lines, %d%% session lines" % (lines, share * 100)
+        with open(filename, "r") as log:
+            fast = timed("prefilter + regex", fog_logins.session_logs(log))
+        try:
+            import logsparser
+        except ImportError:
+            print "logsparser is not installed, comparison skipped"
+            return
+        slow = timed("logsparser for every line", logsparser_logs(filename))
+        if fast != slow:
+            print "the two paths found different events"
+    finally:
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
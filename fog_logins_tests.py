@@ -0,0 +1,403 @@
+import datetime
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import fog_logins
+
+
+def syslog_date(text, now):
+    return fog_logins._syslog_date(fog_logins.SYSLOG_DATE_RE.match(text),
+                                   now)
+
+
+class SyslogDateTests(unittest.TestCase):
+
+    def test_uses_the_current_year(self):
+        self.assertEqual(syslog_date("Mar  1 10:00:00 ",
+                                     datetime.datetime(2027, 6, 1)),
+                         datetime.datetime(2027, 3, 1, 10))
+
+    def test_uses_last_year_for_dates_in_the_future(self):
+        self.assertEqual(syslog_date("Dec 31 23:00:00 ",
+                                     datetime.datetime(2028, 1, 1)),
+                         datetime.datetime(2027, 12, 31, 23))
+
+    def test_accepts_feb_29_of_a_leap_year(self):
+        self.assertEqual(syslog_date("Feb 29 10:00:00 ",
+                                     datetime.datetime(2028, 3, 1)),
+                         datetime.datetime(2028, 2, 29, 10))
+
+    def test_returns_none_for_feb_29_out_of_a_leap_year(self):
+        self.assertEqual(syslog_date("Feb 29 10:00:00 ",
+                                     datetime.datetime(2027, 3, 1)),
+                         None)
+
+    def test_parse_session_line_skips_invalid_dates(self):
+        line = ("Feb 30 10:00:00 host lightdm: pam_unix(lightdm:session): "
+                "session opened for user alice by (uid=0)\n")
+        self.assertEqual(fog_logins.parse_session_line(line), None)
+
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "test_data")
+JOURNAL_EXPORT = os.path.join(TEST_DATA, "journal.export")
+JOURNAL_JSON = os.path.join(TEST_DATA, "journal.json")
+
+
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.state = os.path.join(self.dirname, "journal_state")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def entries(self, filename):
+        with open(filename, "rb") as recorded:
+            return list(fog_logins.journal_entries(recorded))
+
+    def events(self, filename):
+        reader = fog_logins.JournalReader(filename, self.state)
+        events = [(log["date"], log["program"], log["user"], log["action"])
+                  for log in reader.session_logs()]
+        reader.commit()
+        return events
+
+    def test_parses_export_format(self):
+        entries = self.entries(JOURNAL_EXPORT)
+        self.assertEqual([entry["__CURSOR"] for entry in entries],
+                         ["s=1;i=1", "s=1;i=2", "s=1;i=3", "s=1;i=4"])
+        self.assertEqual(entries[1]["MESSAGE"], "New session 3 of user alice.")
+
+    def test_parses_binary_export_fields(self):
+        message = self.entries(JOURNAL_EXPORT)[2]["MESSAGE"]
+        self.assertEqual(message, "pam_unix(sshd:session): session opened "
+                                  "for user bob by (uid=0)\nwith a second "
+                                  "line")
+
+    def test_parses_json_format(self):
+        entries = self.entries(JOURNAL_JSON)
+        self.assertEqual([entry["SYSLOG_IDENTIFIER"] for entry in entries],
+                         ["lightdm", "systemd-logind", "sshd", "lightdm"])
+
+    def test_reads_session_events(self):
+        start = datetime.datetime.fromtimestamp(1798790400)
+        minute = datetime.timedelta(minutes=1)
+        self.assertEqual(self.events(JOURNAL_EXPORT),
+                         [(start, "lightdm", "alice", "open"),
+                          (start + 2 * minute, "sshd", "bob", "open"),
+                          (start + 3 * minute, "lightdm", "alice", "close")])
+
+    def test_json_and_export_give_the_same_events(self):
+        export_events = self.events(JOURNAL_EXPORT)
+        os.remove(self.state)
+        self.assertEqual(self.events(JOURNAL_JSON), export_events)
+
+    def test_resumes_after_the_committed_cursor(self):
+        self.events(JOURNAL_EXPORT)
+        self.assertEqual(self.events(JOURNAL_EXPORT), [])
+        fog_logins.state_write(self.state, "s=1;i=2")
+        self.assertEqual([event[2:] for event in self.events(JOURNAL_JSON)],
+                         [("bob", "open"), ("alice", "close")])
+
+
+class SeekDateTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as log:
+            for second in xrange(20000):
+                log.write("Jan  1 00:%02d:%02d host sshd[1]: noise line\n"
+                          % (second // 60 % 60, second % 60))
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_reads_everything_when_nothing_was_read(self):
+        end = os.path.getsize(self.filename)
+        self.assertEqual(fog_logins.seek_date(self.filename,
+                                              datetime.datetime.min, 0, end),
+                         0)
+
+
+class SessionIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def index(self):
+        reader = fog_logins.JournalReader(
+            JOURNAL_EXPORT, os.path.join(self.dirname, "journal_state"))
+        return fog_logins.SessionIndex(os.path.join(self.dirname, "sessions"),
+                                       ["journal"], reader)
+
+    def test_is_fed_by_the_login_source(self):
+        index = self.index()
+        index.refresh()
+        self.assertFalse(index.logged_in("lightdm"))
+        self.assertTrue(index.logged_in("sshd"))
+
+    def test_keeps_the_sessions_across_refreshes(self):
+        self.index().refresh()
+        index = self.index()
+        index.refresh()
+        self.assertTrue(index.logged_in("sshd"))
+
+    def test_starts_over_when_the_sources_change(self):
+        self.index().refresh()
+        index = fog_logins.SessionIndex(
+            os.path.join(self.dirname, "sessions"), ["wtmp"],
+            fog_logins.WtmpReader(os.path.join(self.dirname, "wtmp"),
+                                  os.path.join(self.dirname, "wtmp_state")))
+        self.assertEqual(index.sessions, {})
+
+
+class LoginWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.machine = os.path.join(self.dirname, "journal", "machine")
+        os.makedirs(self.machine)
+        self.saved = (fog_logins.JOURNAL_DIRS, fog_logins.AUTH_LOG,
+                      fog_logins.journal_cursor)
+        fog_logins.JOURNAL_DIRS = [os.path.dirname(self.machine)]
+        fog_logins.AUTH_LOG = os.path.join(self.dirname, "auth.log")
+        self.cursor = "s=1;i=1"
+        fog_logins.journal_cursor = lambda: self.cursor
+        self.watcher = fog_logins.login_watcher(["auth.log", "journal"])
+
+    def tearDown(self):
+        self.watcher.close()
+        (fog_logins.JOURNAL_DIRS, fog_logins.AUTH_LOG,
+         fog_logins.journal_cursor) = self.saved
+        shutil.rmtree(self.dirname)
+
+    def write(self, filename):
+        with open(filename, "a") as log:
+            log.write("line\n")
+
+    def test_journal_writes_without_login_entries_are_ignored(self):
+        self.write(os.path.join(self.machine, "system.journal"))
+        self.assertEqual(self.watcher.wait(1), set())
+
+    def test_new_login_entries_in_the_journal_count(self):
+        self.write(os.path.join(self.machine, "system.journal"))
+        self.cursor = "s=1;i=2"
+        self.assertEqual(self.watcher.wait(1), set(["system.journal"]))
+
+    def test_watched_files_always_count(self):
+        self.write(fog_logins.AUTH_LOG)
+        self.write(os.path.join(self.machine, "system.journal"))
+        self.assertEqual(self.watcher.wait(1),
+                         set(["auth.log", "system.journal"]))
+
+
+def utmp(kind, line, user="", host="", seconds=0):
+    """Returns a struct utmp record as Linux writes it to wtmp"""
+    record = struct.pack("<hxxi32s4s32s256s", kind, 1, line, "", user, host)
+    record += "\0" * 8 + struct.pack("<i", seconds)
+    return record + "\0" * (fog_logins.WtmpReader.RECORD_SIZE - len(record))
+
+
+USER, DEAD = fog_logins.WtmpReader.USER_PROCESS, \
+    fog_logins.WtmpReader.DEAD_PROCESS
+
+
+class WtmpReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.wtmp = os.path.join(self.dirname, "wtmp")
+        self.state = os.path.join(self.dirname, "wtmp_state")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def append(self, *records):
+        with open(self.wtmp, "ab") as wtmp:
+            wtmp.write("".join(records))
+
+    def events(self):
+        reader = fog_logins.WtmpReader(self.wtmp, self.state)
+        events = [(log["program"], log["user"], log["action"])
+                  for log in reader.session_logs()]
+        reader.commit()
+        return events
+
+    def test_decodes_opens_and_closes(self):
+        self.append(utmp(USER, ":0", "alice", ":0", 100),
+                    utmp(USER, "pts/0", "bob", "10.0.0.1", 200),
+                    utmp(USER, "tty1", "carol", "", 300),
+                    utmp(6, "tty2", "LOGIN", "", 350),
+                    utmp(DEAD, "pts/0", "", "", 400),
+                    utmp(DEAD, ":0", "", "", 500))
+        self.assertEqual(self.events(),
+                         [("lightdm", "alice", "open"),
+                          ("sshd", "bob", "open"),
+                          ("login", "carol", "open"),
+                          ("sshd", "bob", "close"),
+                          ("lightdm", "alice", "close")])
+
+    def test_dates_come_from_the_records(self):
+        self.append(utmp(USER, ":0", "alice", ":0", 1798790400))
+        reader = fog_logins.WtmpReader(self.wtmp, self.state)
+        self.assertEqual([log["date"] for log in reader.session_logs()],
+                         [datetime.datetime.fromtimestamp(1798790400)])
+
+    def test_resumes_after_the_committed_record(self):
+        self.append(utmp(USER, ":0", "alice", ":0", 100))
+        self.events()
+        self.assertEqual(self.events(), [])
+        # a partly written record is left for the next read
+        self.append(utmp(DEAD, ":0", "", "", 200), "\0" * 100)
+        self.assertEqual(self.events(), [("lightdm", "alice", "close")])
+
+    def test_finishes_the_rotated_file_and_keeps_the_sessions(self):
+        self.append(utmp(USER, ":0", "alice", ":0", 100),
+                    utmp(USER, "pts/0", "bob", "10.0.0.1", 200))
+        self.events()
+        # written after the last read, then wtmp is rotated
+        self.append(utmp(DEAD, ":0", "", "", 300),
+                    utmp(USER, "pts/1", "carol", "10.0.0.2", 400))
+        os.rename(self.wtmp, self.wtmp + ".1")
+        self.append(utmp(DEAD, "pts/0", "", "", 500),
+                    utmp(DEAD, "pts/1", "", "", 600))
+        self.assertEqual(self.events(),
+                         [("lightdm", "alice", "close"),
+                          ("sshd", "carol", "open"),
+                          ("sshd", "bob", "close"),
+                          ("sshd", "carol", "close")])
+        self.assertEqual(self.events(), [])
+
+
+def auth_line(user, action="opened", minutes=0):
+    date = datetime.datetime.now() - datetime.timedelta(minutes=60 - minutes)
+    return ("%s host sshd[1]: pam_unix(sshd:session): session %s for user "
+            "%s\n" % (date.strftime("%b %d %H:%M:%S"), action, user))
+
+
+class AuthLogReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.log = os.path.join(self.dirname, "auth.log")
+        self.state = os.path.join(self.dirname, "auth_log_state")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def append(self, filename, *lines):
+        with open(filename, "ab") as log:
+            log.write("".join(lines))
+
+    def reader(self):
+        return fog_logins.AuthLogReader(self.log, self.state)
+
+    def read(self, since=None):
+        reader = self.reader()
+        lines = list(reader.lines(since))
+        reader.commit()
+        return lines
+
+    def test_resumes_after_the_committed_offset(self):
+        self.append(self.log, "one\n", "two\n")
+        self.assertEqual(self.read(), ["one\n", "two\n"])
+        self.assertEqual(self.read(), [])
+        self.append(self.log, "three\n")
+        self.assertEqual(self.read(), ["three\n"])
+
+    def test_leaves_a_partial_trailing_line_for_later(self):
+        self.append(self.log, "one\n", "tw")
+        self.assertEqual(self.read(), ["one\n"])
+        self.append(self.log, "o\n")
+        self.assertEqual(self.read(), ["two\n"])
+
+    def test_starts_over_when_the_log_is_truncated(self):
+        self.append(self.log, "a long first line\n")
+        self.read()
+        with open(self.log, "wb") as log:
+            log.write("new\n")
+        self.assertEqual(self.read(), ["new\n"])
+
+    def test_finishes_the_log_rotated_into_dot_1(self):
+        self.append(self.log, "one\n")
+        self.read()
+        self.append(self.log, "two\n")
+        os.rename(self.log, self.log + ".1")
+        self.append(self.log, "three\n")
+        self.assertEqual(self.read(), ["two\n", "three\n"])
+        self.assertEqual(self.read(), [])
+
+    def test_follows_the_rotated_logs_in_order(self):
+        with gzip.open(self.log + ".2.gz", "wb") as log:
+            log.write(auth_line("alice") + auth_line("bob", minutes=1))
+        self.append(self.log + ".1", auth_line("alice", "closed", 2))
+        self.append(self.log, auth_line("bob", "closed", 3))
+        logs = list(self.reader().session_logs())
+        self.assertEqual([(log["user"], log["action"]) for log in logs],
+                         [("alice", "open"), ("bob", "open"),
+                          ("alice", "close"), ("bob", "close")])
+
+    def test_resumes_inside_a_compressed_log(self):
+        with gzip.open(self.log + ".2.gz", "wb") as log:
+            log.write("one\ntwo\nthree\n")
+        self.append(self.log, "four\n")
+        reader = self.reader()
+        lines = reader.lines()
+        self.assertEqual(next(lines), "one\n")
+        reader.commit()
+        self.assertEqual(self.read(), ["two\n", "three\n", "four\n"])
+
+    def test_plain_offset_is_not_reused_on_a_compressed_log(self):
+        with gzip.open(self.log + ".1.gz", "wb") as log:
+            log.write("one\ntwo\n")
+        inode = os.stat(self.log + ".1.gz").st_ino
+        # the inode of a plain log read up to offset 4, reused by the .gz
+        fog_logins.state_write(self.state, "%d 4" % inode)
+        self.assertEqual(self.read(), ["one\n", "two\n"])
+        fog_logins.state_write(self.state, "%d 4 gz" % inode)
+        self.assertEqual(self.read(), ["two\n"])
+
+
+class ParallelSessionLogsTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as log:
+            for minute in xrange(60):
+                log.write(auth_line("user%d" % (minute % 7),
+                                    ["opened", "closed"][minute % 2], minute))
+                log.write("Jan  1 00:00:00 host CRON[2]: noise %d\n" % minute)
+        self.size = os.path.getsize(self.filename)
+        with open(self.filename, "r") as log:
+            self.serial = list(fog_logins.session_logs(log))
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_chunks_splitting_lines_give_the_serial_output(self):
+        self.assertEqual(len(self.serial), 60)
+        for chunk_size in [1, 7, 50, 333, self.size]:
+            logs = list(fog_logins.parallel_session_logs(
+                self.filename, 0, self.size, 2, chunk_size))
+            self.assertEqual(logs, self.serial, chunk_size)
+
+    def test_reader_catch_up_gives_the_serial_output(self):
+        saved = fog_logins.CATCH_UP_BYTES
+        fog_logins.CATCH_UP_BYTES = 0
+        dirname = tempfile.mkdtemp()
+        try:
+            reader = fog_logins.AuthLogReader(
+                self.filename, os.path.join(dirname, "state"), processes=3)
+            self.assertEqual(list(reader.session_logs()), self.serial)
+        finally:
+            fog_logins.CATCH_UP_BYTES = saved
+            shutil.rmtree(dirname)
@@ -0,0 +1,247 @@
+"""Multicast distribution of snapin files between clients
+
+A stream is identified by the sha256 of the file, as given by the fog
+server, so receivers only accept a file matching the hash the server sent
+them, whoever streams it.
+
+Clients wanting the same file wait for a stream. If none shows up they
+elect a leader: each sends a CLAIM with a random nonce and the lowest nonce
+wins. The leader keeps claiming while it downloads the file from the
+server, then streams it once. Receivers collect the numbered blocks and ask
+for the missing ones with NACK packets.
+
+Any host of the network can send packets to the group, so receivers drop
+the ones that are malformed or don't agree with the size first announced
+for the stream, and check the hash of what they put together.
+"""
+import hashlib
+import itertools
+import logging
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+MAGIC = "FOGM"
+BLOCK_SIZE = 1024
+
+DATA, NACK, ANNOUNCE, CLAIM = 1, 2, 3, 4
+
+HEADER = struct.Struct("!4sB16s")
+DATA_HEADER = struct.Struct("!II")
+ANNOUNCE_BODY = struct.Struct("!IQ")
+CLAIM_BODY = struct.Struct("!Q")
+SEQ = struct.Struct("!I")
+
+MAX_NACK_SEQS = 256
+# missing blocks asked for at once, more are asked once these arrive
+MAX_NACK_ROUND = 4 * MAX_NACK_SEQS
+MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+
+def stream_id(digest):
+    """Returns the id of the stream of the file with sha256 :digest"""
+    return digest[:16]
+
+
+def _group_socket(group, port, ttl=1):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("", port))
+    membership = struct.pack("4s4s", socket.inet_aton(group),
+                             socket.inet_aton("0.0.0.0"))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    return sock
+
+
+def _parse(packet, sid):
+    """Returns (type, body) of :packet if it belongs to stream :sid"""
+    if len(packet) < HEADER.size:
+        return None, None
+    magic, kind, packet_sid = HEADER.unpack_from(packet)
+    if magic != MAGIC or packet_sid != sid:
+        return None, None
+    return kind, packet[HEADER.size:]
+
+
+class MulticastSender(object):
+    """Streams the file with sha256 :digest to the group and repairs the
+    blocks receivers miss"""
+    def __init__(self, group, port, digest, rate_delay=0.0005):
+        super(MulticastSender, self).__init__()
+        self.group = group
+        self.port = port
+        self.sid = stream_id(digest)
+        self.rate_delay = rate_delay
+        self.data = ""
+        self.blocks = 0
+        self.sock = _group_socket(group, port)
+        self.claiming = threading.Event()
+
+    def _send(self, kind, body):
+        packet = HEADER.pack(MAGIC, kind, self.sid) + body
+        self.sock.sendto(packet, (self.group, self.port))
+
+    def _send_announce(self):
+        self._send(ANNOUNCE, ANNOUNCE_BODY.pack(self.blocks, len(self.data)))
+
+    def _send_block(self, seq):
+        start = seq * BLOCK_SIZE
+        payload = self.data[start:start + BLOCK_SIZE]
+        self._send(DATA, DATA_HEADER.pack(seq, self.blocks) + payload)
+        time.sleep(self.rate_delay)
+
+    def claim(self, nonce, interval=1.0):
+        """Claims the stream with :nonce every :interval seconds, so other
+        receivers keep waiting, until serve() or close() is called"""
+        def claim_loop():
+            while self.claiming.is_set():
+                self._send(CLAIM, CLAIM_BODY.pack(nonce))
+                time.sleep(interval)
+        self.claiming.set()
+        claimer = threading.Thread(target=claim_loop)
+        claimer.daemon = True
+        claimer.start()
+
+    def serve(self, data, linger=5.0):
+        """Sends every block of :data once and answers NACKs until :linger
+        seconds pass without any of them"""
+        self.claiming.clear()
+        self.data = data
+        self.blocks = (len(data) + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self._send_announce()
+        for seq in xrange(self.blocks):
+            self._send_block(seq)
+        self._send_announce()
+
+        repaired = 0
+        deadline = time.time() + linger
+        while time.time() < deadline:
+            ready, _, _ = select.select([self.sock], [], [],
+                                        min(1.0, deadline - time.time()))
+            if not ready:
+                self._send_announce()
+                continue
+            kind, body = _parse(self.sock.recv(65535), self.sid)
+            if kind != NACK:
+                continue
+            count = len(body) // SEQ.size
+            missing = struct.unpack("!%dI" % count, body[:count * SEQ.size])
+            for seq in missing:
+                if seq < self.blocks:
+                    self._send_block(seq)
+            self._send_announce()
+            repaired += count
+            deadline = time.time() + linger
+        logging.info("Multicast stream of %d blocks served, %d repaired",
+                     self.blocks, repaired)
+        self.close()
+
+    def close(self):
+        self.claiming.clear()
+        self.sock.close()
+
+
+class MulticastReceiver(object):
+    """Collects the file with sha256 :digest from the group"""
+    def __init__(self, group, port, digest):
+        super(MulticastReceiver, self).__init__()
+        self.group = group
+        self.port = port
+        self.digest = digest
+        self.sid = stream_id(digest)
+        self.nonce = random.SystemRandom().getrandbits(63)
+        self.sock = _group_socket(group, port)
+
+    def _send(self, kind, body):
+        packet = HEADER.pack(MAGIC, kind, self.sid) + body
+        self.sock.sendto(packet, (self.group, self.port))
+
+    def _send_nack(self, missing):
+        for start in xrange(0, len(missing), MAX_NACK_SEQS):
+            seqs = missing[start:start + MAX_NACK_SEQS]
+            self._send(NACK, struct.pack("!%dI" % len(seqs), *seqs))
+
+    def _nack_missing(self, blocks, total):
+        missing = (seq for seq in xrange(total) if seq not in blocks)
+        self._send_nack(list(itertools.islice(missing, MAX_NACK_ROUND)))
+
+    def receive(self, timeout=10.0, idle=0.2, claim_window=0.5,
+                max_size=MAX_SIZE):
+        """Returns the streamed data, or None if this client was elected to
+        get the file from the server and stream it: nobody streamed or
+        claimed it for :timeout seconds, and no peer with a lower nonce
+        claimed it within :claim_window seconds of our claim.
+
+        The stream size is the first one announced, up to :max_size bytes.
+        Packets not agreeing with it are dropped.
+
+        Raises ValueError if the data does not match the digest.
+        """
+        max_blocks = (max_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        blocks = {}
+        total = None
+        last_packet = time.time()
+        claimed = None
+        try:
+            while total is None or len(blocks) < total:
+                now = time.time()
+                if claimed is not None and now - claimed > claim_window:
+                    return None
+                if claimed is None and now - last_packet > timeout:
+                    self._send(CLAIM, CLAIM_BODY.pack(self.nonce))
+                    claimed = now
+                    continue
+                ready, _, _ = select.select([self.sock], [], [], idle)
+                if not ready:
+                    if total is not None:
+                        self._nack_missing(blocks, total)
+                    continue
+                kind, body = _parse(self.sock.recv(65535), self.sid)
+                try:
+                    if kind == CLAIM:
+                        nonce, = CLAIM_BODY.unpack_from(body)
+                        if nonce == self.nonce:
+                            continue
+                        if claimed is not None and nonce > self.nonce:
+                            # we win, the other peer backs off on our claim
+                            continue
+                    elif kind == DATA:
+                        seq, count = DATA_HEADER.unpack_from(body)
+                        payload = body[DATA_HEADER.size:]
+                        if (count != total or seq >= total
+                                or len(payload) > BLOCK_SIZE):
+                            continue
+                        blocks[seq] = payload
+                    elif kind == ANNOUNCE:
+                        count, size = ANNOUNCE_BODY.unpack_from(body)
+                        if total is None:
+                            if (size > max_size or count > max_blocks or
+                                    count != (size + BLOCK_SIZE - 1)
+                                    // BLOCK_SIZE):
+                                continue
+                            total = count
+                        elif count != total:
+                            continue
+                        if len(blocks) < total:
+                            self._nack_missing(blocks, total)
+                    else:
+                        continue
+                except struct.error:
+                    continue
+                claimed = None
+                last_packet = time.time()
+        finally:
+            self.sock.close()
+
+        data = "".join(blocks[seq] for seq in xrange(total))
+        if hashlib.sha256(data).digest() != self.digest:
+            raise ValueError("Multicast stream does not match the snapin "
+                             "hash")
+        return data
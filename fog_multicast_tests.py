@@ -0,0 +1,135 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+
+import fog_multicast
+from fog_multicast import MulticastReceiver, MulticastSender
+
+GROUP = "239.255.42.99"
+
+
+def peer(port, digest, data, results):
+    """A client wanting the file, it has :data if elected, as if it had
+    downloaded it from the server"""
+    receiver = MulticastReceiver(GROUP, port, digest)
+    received = receiver.receive(timeout=0.5, claim_window=0.3)
+    if received is not None:
+        results.put(("receiver", received))
+        return
+    sender = MulticastSender(GROUP, port, digest)
+    sender.claim(receiver.nonce, interval=0.2)
+    time.sleep(0.5)
+    results.put(("leader", data))
+    sender.serve(data, linger=1.0)
+
+
+class MulticastTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(200 * 1024 + 17)
+        self.digest = hashlib.sha256(self.data).digest()
+
+    def test_peers_elect_one_leader_and_all_get_the_file(self):
+        results = multiprocessing.Queue()
+        peers = [multiprocessing.Process(target=peer,
+                                         args=(9301, self.digest, self.data,
+                                               results))
+                 for _ in xrange(4)]
+        for process in peers:
+            process.start()
+        roles = [results.get(timeout=30) for _ in peers]
+        for process in peers:
+            process.join(30)
+        self.assertEqual(sorted(role for role, _ in roles),
+                         ["leader", "receiver", "receiver", "receiver"])
+        for _, data in roles:
+            self.assertEqual(data, self.data)
+
+    def test_receiver_rejects_data_not_matching_the_hash(self):
+        forged = MulticastSender(GROUP, 9302, self.digest)
+        receiver = MulticastReceiver(GROUP, 9302, self.digest)
+        server = threading.Thread(target=forged.serve,
+                                  args=("evil" * 1000, 0.5))
+        server.start()
+        try:
+            self.assertRaises(ValueError, receiver.receive, 2.0)
+        finally:
+            server.join()
+
+    def test_receiver_is_elected_when_nobody_streams(self):
+        receiver = MulticastReceiver(GROUP, 9303, self.digest)
+        self.assertEqual(receiver.receive(timeout=0.2, claim_window=0.2),
+                         None)
+
+
+class ForgedPacketTests(unittest.TestCase):
+    """Packets any host of the network could send to the group"""
+
+    def setUp(self):
+        self.data = os.urandom(20 * 1024 + 17)
+        self.digest = hashlib.sha256(self.data).digest()
+        self.sid = fog_multicast.stream_id(self.digest)
+
+    def forge(self, port, kind, body):
+        sock = fog_multicast._group_socket(GROUP, port)
+        try:
+            sock.sendto(fog_multicast.HEADER.pack(fog_multicast.MAGIC, kind,
+                                                  self.sid) + body,
+                        (GROUP, port))
+        finally:
+            sock.close()
+
+    def test_malformed_and_forged_packets_are_dropped(self):
+        port = 9304
+        receiver = MulticastReceiver(GROUP, port, self.digest)
+        DATA_HEADER = fog_multicast.DATA_HEADER
+        for kind, body in [
+                (fog_multicast.DATA, "\0\1"),
+                (fog_multicast.CLAIM, "\0"),
+                (fog_multicast.ANNOUNCE, "\0\0\0"),
+                # sizes that don't agree with each other or are too large
+                (fog_multicast.ANNOUNCE,
+                 fog_multicast.ANNOUNCE_BODY.pack(3, 100 * 1024)),
+                (fog_multicast.ANNOUNCE,
+                 fog_multicast.ANNOUNCE_BODY.pack(2 ** 32 - 1, 2 ** 42)),
+                # block numbers out of the stream
+                (fog_multicast.DATA, DATA_HEADER.pack(5, 2) + "x"),
+                (fog_multicast.DATA, DATA_HEADER.pack(2 ** 32 - 1, 21)),
+                (fog_multicast.DATA, DATA_HEADER.pack(0, 21) + "x" * 4096)]:
+            self.forge(port, kind, body)
+        sender = MulticastSender(GROUP, port, self.digest)
+        server = threading.Thread(target=sender.serve,
+                                  args=(self.data, 0.5))
+        server.start()
+        try:
+            self.assertEqual(receiver.receive(timeout=2.0), self.data)
+        finally:
+            server.join()
+
+    def test_blocks_of_another_size_are_dropped(self):
+        port = 9305
+        receiver = MulticastReceiver(GROUP, port, self.digest)
+        self.forge(port, fog_multicast.ANNOUNCE,
+                   fog_multicast.ANNOUNCE_BODY.pack(21, len(self.data)))
+        for seq in xrange(30):
+            self.forge(port, fog_multicast.DATA,
+                       fog_multicast.DATA_HEADER.pack(seq, 30) + "x")
+        sender = MulticastSender(GROUP, port, self.digest)
+        server = threading.Thread(target=sender.serve,
+                                  args=(self.data, 0.5))
+        server.start()
+        try:
+            self.assertEqual(receiver.receive(timeout=2.0), self.data)
+        finally:
+            server.join()
+
+    def test_huge_announced_stream_is_ignored(self):
+        port = 9306
+        receiver = MulticastReceiver(GROUP, port, self.digest)
+        self.forge(port, fog_multicast.ANNOUNCE,
+                   fog_multicast.ANNOUNCE_BODY.pack(2 ** 22, 2 ** 32))
+        self.assertEqual(receiver.receive(timeout=0.3, claim_window=0.2,
+                                          max_size=1024 * 1024), None)
@@ -0,0 +1,179 @@
+"""System operations used by fog_client
+
+Three backends are available:
+
+- native, made of system calls and direct file access
+- cuisine, which runs shell commands through Fabric as earlier versions
+  did, only imported when selected
+- helper, which asks a long-lived privileged fog_client helper over a unix
+  socket, for clients that don't run as root
+
+The native backend does not use sudo, the client is expected to run as
+root as the upstart job does.
+"""
+import json
+import os
+import socket
+import subprocess
+import threading
+
+HOSTNAME_PROC = "/proc/sys/kernel/hostname"
+HOSTNAME_FILE = "/etc/hostname"
+HOSTS_FILE = "/etc/hosts"
+HELPER_SOCKET = "/var/run/fog_client_helper.sock"
+
+
+class NativeOps(object):
+    """Operations made in process, forking only to run other programs"""
+    def hostname(self):
+        with open(HOSTNAME_PROC, "r") as hostname_file:
+            return hostname_file.read().strip()
+
+    def set_hostname(self, host):
+        with open(HOSTNAME_PROC, "w") as hostname_file:
+            hostname_file.write(host)
+
+    def update_hosts(self, old, host):
+        """Replaces hostname :old with :host in /etc/hostname and
+        /etc/hosts"""
+        with open(HOSTNAME_FILE, "w") as hostname_file:
+            hostname_file.write(host)
+        with open(HOSTS_FILE, "r") as hosts_file:
+            contents = hosts_file.read()
+        with open(HOSTS_FILE, "w") as hosts_file:
+            hosts_file.write(contents.replace(old, host))
+
+    def execute(self, filename, run_with, run_with_args, args):
+        """Makes snapin :filename executable and runs it, returns its exit
+        code"""
+        os.chmod(filename, 0o700)
+        line = " ".join([run_with, run_with_args, filename, args])
+        return subprocess.call(line, shell=True)
+
+    def run(self, args):
+        """Runs the program :args and returns its output, raises
+        CalledProcessError if it fails"""
+        return subprocess.check_output(args)
+
+    def reboot(self):
+        subprocess.call(["reboot", "-f"])
+
+    def halt(self):
+        subprocess.call(["halt"])
+
+
+class CuisineOps(NativeOps):
+    """Operations run as shell commands through cuisine"""
+    def __init__(self):
+        super(CuisineOps, self).__init__()
+        import cuisine
+        self.c = cuisine
+
+    def hostname(self):
+        with self.c.mode_local():
+            return self.c.run("hostname").strip()
+
+    def set_hostname(self, host):
+        with self.c.mode_local():
+            with self.c.mode_sudo():
+                self.c.run("hostname " + host)
+
+    def execute(self, filename, run_with, run_with_args, args):
+        with self.c.mode_local():
+            with self.c.mode_sudo():
+                self.c.file_ensure(filename, mode="700")
+        line = " ".join([run_with, run_with_args, filename, args])
+        return subprocess.call(line, shell=True)
+
+    def run(self, args):
+        with self.c.mode_local():
+            with self.c.mode_sudo():
+                return self.c.run(" ".join(args))
+
+    def reboot(self):
+        with self.c.mode_local():
+            with self.c.mode_sudo():
+                self.c.run("reboot -f")
+
+    def halt(self):
+        with self.c.mode_local():
+            with self.c.mode_sudo():
+                self.c.run("halt")
+
+
+class HelperOps(NativeOps):
+    """Privileged operations sent to the fog_client helper listening on
+    :socket_path, one JSON request and response per line over a connection
+    kept open between calls"""
+    def __init__(self, socket_path=HELPER_SOCKET):
+        super(HelperOps, self).__init__()
+        self.socket_path = socket_path
+        self.lock = threading.Lock()
+        self.stream = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.stream = sock.makefile("rwb", 0)
+        sock.close()
+
+    def _send(self, request):
+        if self.stream is None:
+            self._connect()
+        self.stream.write(request)
+
+    def _call(self, op, **args):
+        request = json.dumps({"op": op, "args": args}) + "\n"
+        with self.lock:
+            try:
+                self._send(request)
+            except socket.error:
+                # a helper restart closed the connection kept from the
+                # last call, the request was not delivered
+                self.stream = None
+                self._send(request)
+            line = self.stream.readline()
+            if not line:
+                self.stream = None
+                raise IOError("fog_client helper closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise OSError("fog_client helper: " + response["error"])
+        return response.get("result")
+
+    def set_hostname(self, host):
+        self._call("sethostname", host=host)
+
+    def update_hosts(self, old, host):
+        self._call("update_hosts", old=old, host=host)
+
+    def execute(self, filename, run_with, run_with_args, args):
+        return self._call("execute", filename=filename, run_with=run_with,
+                          run_with_args=run_with_args, args=args)
+
+    def run(self, args):
+        return self._call("run", args=args)
+
+    def reboot(self):
+        self._call("reboot")
+
+    def halt(self):
+        self._call("halt")
+
+
+BACKENDS = {"native": NativeOps, "cuisine": CuisineOps, "helper": HelperOps}
+
+_backend = {}
+
+
+def use(name, **options):
+    """Selects the backend :name, made with :options, for the following
+    operations"""
+    _backend["ops"] = BACKENDS[name](**options)
+
+
+def ops():
+    """Returns the selected backend, native if none was"""
+    if "ops" not in _backend:
+        use("native")
+    return _backend["ops"]
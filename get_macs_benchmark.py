@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Benchmark of fog_lib.get_macs
+
+Times finding the MACs by running ifconfig and matching its output, as
+get_macs used to (without the overhead of going through Fabric), against
+reading sysfs, as get_macs does on a cache miss, and against the cached
+answer. The ifconfig run is skipped if it is not installed.
+
+Usage: get_macs_benchmark.py [calls]
+"""
+import re
+import subprocess
+import sys
+import time
+
+import fog_lib
+
+MAC_RE = re.compile("([a-fA-F0-9]{2}[:|\-]?){6}")
+
+
+def ifconfig_macs():
+    ifconfig = subprocess.check_output(["ifconfig"])
+    return [MAC_RE.search(line).group() for line in ifconfig.splitlines()
+            if 'ether' in line]
+
+
+def sysfs_macs():
+    return [mac for _, mac, _ in fog_lib._interfaces()]
+
+
+def timed(name, func, calls):
+    start = time.time()
+    for _ in xrange(calls):
+        macs = func()
+    elapsed = time.time() - start
+    print "%-30s %8.4fms per call %s" % (name, elapsed * 1000 / calls,
+                                          ", ".join(macs))
+
+
+def main(args):
+    calls = int(args[0]) if args else 200
+    print "%d calls each" % calls
+    try:
+        timed("ifconfig + regex", ifconfig_macs, calls)
+    except OSError:
+        print "ifconfig is not installed, skipped"
+    timed("sysfs read (cache miss)", sysfs_macs, calls)
+    fog_lib.get_macs()
+    timed("cached", fog_lib.get_macs, calls)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,7 +3,7 @@ import datetime
 import base64
 
 import cliapp
-from fog_lib import FogRequester, shutdown, get_macs
+from fog_lib import FogRequester, shutdown
 
 
 class GreenFogRequester(FogRequester):
@@ -66,7 +66,8 @@ class GreenFogPlugin(cliapp.Plugin):
                 if task.due_now:
                     logging.info("Green Fog task pending,")
                     status, reboot = shutdown(mode=task.task_type,
-                                              allow_reboot=allow_reboot)
+                                              allow_reboot=allow_reboot,
+                                              context=self.app.context)
                 else:
                     logging.info("Green Fog Task due at " + task.hour)
                     status, reboot = False, False
@@ -81,4 +82,4 @@ class GreenFogPlugin(cliapp.Plugin):
         fog_host = self.app.settings["fog_host"]
         allow_reboot = self.app.settings["allow_reboot"]
         return [self._client_green_fog(fog_host, allow_reboot, mac)
-                for mac in get_macs()]
+                for mac in self.app.context.macs()]
@@ -4,7 +4,7 @@ if needed"""
 import logging
 
 import cliapp
-from fog_lib import (get_macs, FogRequester, ensure_hostname)
+from fog_lib import (FogRequester, ensure_hostname)
 
 
 class HostnameRequester(FogRequester):
@@ -34,7 +34,7 @@ class HostnamePlugin(cliapp.Plugin):
         action, reboot = False, False
         try:
             hostname = fog_server.get_hostname_data()
-            action, reboot = ensure_hostname(hostname)
+            action, reboot = ensure_hostname(hostname, self.app.context)
         except IOError as ex:
             logging.error(ex)
         except ValueError as ex:
@@ -46,4 +46,5 @@ class HostnamePlugin(cliapp.Plugin):
     def cmd_hostname(self, args):
         """Sets local hostname to the value saved in fog server"""
         fog_host = self.app.settings["fog_host"]
-        return [self._client_hostname(fog_host, mac) for mac in get_macs()]
+        return [self._client_hostname(fog_host, mac)
+                for mac in self.app.context.macs()]
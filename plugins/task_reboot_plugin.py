@@ -1,7 +1,7 @@
 import logging
 
 import cliapp
-from fog_lib import FogRequester, shutdown, get_macs
+from fog_lib import FogRequester, shutdown
 
 
 class TaskRebootRequester(FogRequester):
@@ -29,7 +29,8 @@ class TaskRebootPlugin(cliapp.Plugin):
             task = fog_server.get_task_reboot_data()
             if task:
                 status, reboot = shutdown(mode=reboot,
-                                          allow_reboot=allow_reboot)
+                                          allow_reboot=allow_reboot,
+                                          context=self.app.context)
 
         except IOError as e:
             logging.info(e)
@@ -42,4 +43,4 @@ class TaskRebootPlugin(cliapp.Plugin):
         fog_host = self.app.settings["fog_host"]
         allow_reboot = self.app.settings["allow_reboot"]
         return [self._client_task_reboot(fog_host, allow_reboot, mac)
-                for mac in get_macs()]
+                for mac in self.app.context.macs()]
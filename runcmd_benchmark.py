@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Benchmark of cliapp.runcmd spawn latency
+
+Runs a single command and a three command pipeline through runcmd, closing
+the inherited fds found in /proc/self/fd as runcmd does, then with
+close_fds=True as it used to, which on Python 2 closes every fd up to
+RLIMIT_NOFILE. The soft limit is raised to :nofile first, up to the hard
+limit, to show how the old path grows with it.
+
+Usage: runcmd_benchmark.py [spawns] [nofile]
+"""
+import resource
+import sys
+import time
+
+import cliapp
+
+SINGLE = [["true"]]
+PIPELINE = [["echo", "spawn"], ["cat"], ["wc", "-c"]]
+
+
+def raise_nofile(nofile):
+    """Raises the soft RLIMIT_NOFILE to :nofile, at most the hard limit,
+    and returns the limit set"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        nofile = min(nofile, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, nofile), hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def timed(name, argvs, spawns, **kwargs):
+    start = time.time()
+    for _ in xrange(spawns):
+        cliapp.runcmd(*argvs, **kwargs)
+    elapsed = time.time() - start
+    print "%-32s %8.2fms per run" % (name, elapsed * 1000 / spawns)
+
+
+def main(args):
+    spawns = int(args[0]) if args else 200
+    nofile = raise_nofile(int(args[1]) if len(args) > 1 else 1024 * 1024)
+    print "%d runs each, RLIMIT_NOFILE %d" % (spawns, nofile)
+    for name, argvs in [("command", SINGLE), ("pipeline", PIPELINE)]:
+        timed(name + ", open fds closed", argvs, spawns)
+        timed(name + ", close_fds=True", argvs, spawns, close_fds=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
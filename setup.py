@@ -5,11 +5,13 @@ setup(
     version='0.6.5',
     author='Carles Gonzalez',
     packages=['components', 'cliapp', ],
-    py_modules=['fog_lib', 'fog_client'],
+    py_modules=['fog_lib', 'fog_client', 'fog_multicast',
+                'fog_logins', 'fog_inotify', 'fog_ops', 'fog_helper'],
     requires=['cuisine',
               'requests (>=0.13)'],
     scripts=['fog_client.py'],
-    data_files=[('/etc/init', ['aux/fog_client.conf']),
+    data_files=[('/etc/init', ['aux/fog_client.conf',
+                               'aux/fog_client_helper.conf']),
                 ('/etc', ['aux/fog_client.ini'])],
     classifiers=[
         'Development Status :: 3 - Alpha',